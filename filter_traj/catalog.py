@@ -0,0 +1,217 @@
+import argparse
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_final_traj_infos(case_result_file):
+    """
+    读取case_result.json中最终sample的信息，返回 (final_sample_idx, traj_infos)；
+    没有final_sample_idx（没有可用的sample）时返回 (None, None)。
+    """
+    with open(case_result_file, 'r') as f:
+        case_result = json.load(f)
+
+    final_sample_idx = case_result.get('final_sample_idx')
+    if final_sample_idx is None:
+        return None, None
+
+    traj_infos = case_result.get('traj_infos', {})
+    traj_infos = {_['sample_idx']: _ for _ in traj_infos}[final_sample_idx]
+    return final_sample_idx, traj_infos
+
+
+def select_final_sample(case_result_file, max_tokens=None, min_tool_calls=None):
+    """只读取元数据并按阈值筛选，通过时返回 (final_sample_idx, traj_infos)，否则返回None"""
+    final_sample_idx, traj_infos = read_final_traj_infos(case_result_file)
+    if final_sample_idx is None:
+        return None
+    if max_tokens is not None and traj_infos['num_tokens_all'] > max_tokens:
+        return None
+    if min_tool_calls is not None and traj_infos['num_tool_calls'] < min_tool_calls:
+        return None
+    return final_sample_idx, traj_infos
+
+
+def select_final_samples(items, max_tokens=None, min_tool_calls=None):
+    """
+    select_final_sample的批量版本，供进程池按批调用（减少进程间通信）。
+    items为 [(i, path)]，返回 (通过筛选的 [(i, path, final_sample_idx, traj_infos)], 读取失败的 [(path, 错误)])。
+    """
+    selected = []
+    errors = []
+    for i, path in items:
+        try:
+            result = select_final_sample(path, max_tokens, min_tool_calls)
+        except Exception as e:
+            errors.append((path, f'{type(e).__name__}: {e}'))
+            continue
+        if result is not None:
+            selected.append((i, path, *result))
+    return selected, errors
+
+
+def _prefix_range(root):
+    """root目录下所有路径的字符串范围 [root/, root0)，可以走主键索引；'0'是'/'的下一个字符"""
+    root = root.rstrip('/')
+    return root + '/', root + '0'
+
+
+class TrajectoryCatalog:
+    """
+    轨迹目录：按路径保存每个case_result.json的mtime/size以及最终sample的traj_infos
+    （num_tokens_all、num_tool_calls单独成列并建索引）。
+
+    只有新增或mtime/size变化的文件会被重新读取，调整MAX_LENGTH、最少工具调用数等阈值时
+    只需查询目录，不必重新读取文件系统。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS case_results (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            final_sample_idx INTEGER,
+            num_tokens_all INTEGER,
+            num_tool_calls INTEGER,
+            traj_infos TEXT,
+            error TEXT,
+            indexed_at REAL
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_case_results_metrics ON case_results (num_tokens_all, num_tool_calls)')
+
+    def _conn(self):
+        # sqlite3连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _known(self, root=None):
+        """已索引文件的 {path: (mtime, size)}，root不为None时只取该目录下的"""
+        if root is None:
+            rows = self._conn().execute('SELECT path, mtime, size FROM case_results')
+        else:
+            rows = self._conn().execute('SELECT path, mtime, size FROM case_results WHERE path >= ? AND path < ?', _prefix_range(root))
+        return {path: (mtime, size) for path, mtime, size in rows}
+
+    @staticmethod
+    def _index_one(path, known):
+        """文件未变化时返回None，否则返回要写入的行"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if known.get(path) == (stat.st_mtime, stat.st_size):
+            return None
+
+        final_sample_idx = traj_infos = error = None
+        try:
+            final_sample_idx, traj_infos = read_final_traj_infos(path)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        return (
+            path, stat.st_mtime, stat.st_size, final_sample_idx,
+            traj_infos.get('num_tokens_all') if traj_infos else None,
+            traj_infos.get('num_tool_calls') if traj_infos else None,
+            json.dumps(traj_infos, ensure_ascii=False) if traj_infos is not None else None,
+            error, time.time(),
+        )
+
+    def update(self, paths, root=None, workers=32, batch_size=2000):
+        """
+        增量更新：paths中新增或mtime/size变化的文件被重新读取（多线程），其余跳过。
+        root不为None时，视paths为该目录下的全部文件，目录中已不存在的路径会被删除。
+        返回各类文件数的统计。
+        """
+        known = self._known(root)
+        stats = {'indexed': 0, 'unchanged': 0, 'failed': 0, 'removed': 0}
+        seen = set()
+        conn = self._conn()
+
+        paths = iter(paths)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(itertools.islice(paths, batch_size))
+                if not batch:
+                    break
+                seen.update(batch)
+                rows = [row for row in executor.map(lambda p: self._index_one(p, known), batch) if row is not None]
+                stats['unchanged'] += len(batch) - len(rows)
+                stats['indexed'] += sum(1 for row in rows if row[7] is None)
+                stats['failed'] += sum(1 for row in rows if row[7] is not None)
+                if rows:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany('INSERT OR REPLACE INTO case_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    conn.execute('COMMIT')
+
+        if root is not None:
+            removed = [(path,) for path in known if path not in seen]
+            if removed:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany('DELETE FROM case_results WHERE path = ?', removed)
+                conn.execute('COMMIT')
+            stats['removed'] = len(removed)
+        return stats
+
+    def select(self, max_tokens=None, min_tool_calls=None, root=None):
+        """返回满足阈值且有最终sample的 [(path, final_sample_idx, traj_infos)]，按路径排序"""
+        conditions = ['final_sample_idx IS NOT NULL']
+        params = []
+        if max_tokens is not None:
+            conditions.append('num_tokens_all <= ?')
+            params.append(max_tokens)
+        if min_tool_calls is not None:
+            conditions.append('num_tool_calls >= ?')
+            params.append(min_tool_calls)
+        if root is not None:
+            conditions.append('path >= ? AND path < ?')
+            params.extend(_prefix_range(root))
+        rows = self._conn().execute(
+            f'SELECT path, final_sample_idx, traj_infos FROM case_results WHERE {" AND ".join(conditions)} ORDER BY path', params)
+        return [(path, final_sample_idx, json.loads(traj_infos)) for path, final_sample_idx, traj_infos in rows]
+
+    def counts(self, root=None):
+        """目录中的文件数、有最终sample的文件数和读取失败的文件数"""
+        sql = 'SELECT COUNT(*), COUNT(final_sample_idx), COUNT(error) FROM case_results'
+        if root is None:
+            row = self._conn().execute(sql).fetchone()
+        else:
+            row = self._conn().execute(sql + ' WHERE path >= ? AND path < ?', _prefix_range(root)).fetchone()
+        return dict(zip(['files', 'with_final_sample', 'errors'], row))
+
+
+if __name__ == '__main__':
+    from discover import discover_files
+
+    parser = argparse.ArgumentParser(description="增量索引轨迹目录下的case_result.json，并按阈值查询")
+    parser.add_argument("traj_path", help="轨迹目录")
+    parser.add_argument("--db", default='./filtered_traj/catalog.db', help="目录数据库路径")
+    parser.add_argument("--no-update", action="store_true", help="不扫描文件系统，只查询已有目录")
+    parser.add_argument("--workers", type=int, default=32, help="读取文件的线程数")
+    parser.add_argument("--max-length", type=int, default=None, help="num_tokens_all上限")
+    parser.add_argument("--min-tool-calls", type=int, default=None, help="num_tool_calls下限")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    catalog = TrajectoryCatalog(args.db)
+    if not args.no_update:
+        start = time.time()
+        stats = catalog.update(discover_files(args.traj_path, ['case_result.json']), root=args.traj_path, workers=args.workers)
+        print(f'Updated in {time.time() - start:.1f}s: {stats}')
+    print(catalog.counts(args.traj_path))
+
+    start = time.time()
+    selected = catalog.select(args.max_length, args.min_tool_calls, root=args.traj_path)
+    print(f'{len(selected)} trajectories with num_tokens_all <= {args.max_length} and num_tool_calls >= {args.min_tool_calls} '
+          f'({(time.time() - start) * 1000:.1f} ms)')
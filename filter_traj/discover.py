@@ -0,0 +1,97 @@
+import fnmatch
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def _compile_patterns(patterns):
+    """把多个glob文件名模式合并为一个正则，一次匹配"""
+    return re.compile('|'.join(f'(?:{fnmatch.translate(p)})' for p in patterns))
+
+
+def _scan_dir(path, matcher):
+    """
+    扫描单个目录，返回 ([(子目录, (st_dev, st_ino))], 匹配的文件列表)；
+    与glob的**一致，跳过以.开头的条目，并跟随指向目录的符号链接。
+    """
+    subdirs = []
+    matches = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        st = entry.stat()
+                        subdirs.append((entry.path, (st.st_dev, st.st_ino)))
+                    elif matcher.match(entry.name):
+                        matches.append(entry.path)
+                except OSError:
+                    continue
+    except (PermissionError, FileNotFoundError, NotADirectoryError):
+        pass
+    return subdirs, matches
+
+
+def walk_files(root, patterns, workers=16):
+    """
+    并行os.scandir遍历root，边发现边yield文件名匹配任一patterns的路径（如 'case_result.json'、'*.parquet'）。
+    每个目录由线程池中的一个任务扫描，子目录作为新任务提交；只遍历一次即可同时找到多种文件。
+    产出顺序取决于各目录扫描完成的先后。
+    与glob('**', recursive=True)一样跟随指向目录的符号链接；按(st_dev, st_ino)记录已扫描的目录，
+    指回祖先目录的链接不会形成死循环，多个链接指向同一目录时也只扫描一次。
+    """
+    matcher = _compile_patterns(patterns)
+    try:
+        root_stat = os.stat(root)
+        visited = {(root_stat.st_dev, root_stat.st_ino)}
+    except OSError:
+        visited = set()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scandir')
+    pending = {executor.submit(_scan_dir, root, matcher)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, matches = future.result()
+                for subdir, key in subdirs:
+                    if key in visited:
+                        continue
+                    visited.add(key)
+                    pending.add(executor.submit(_scan_dir, subdir, matcher))
+                yield from matches
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def discover_files(root, patterns, workers=16, index_path=None, refresh=False):
+    """
+    流式返回root下匹配patterns的文件路径。
+
+    index_path不为None时：
+    - 索引文件已存在且refresh为False，直接读取其中的路径，不再遍历文件系统；
+    - 否则边遍历边写入 index_path + '.tmp'，完整遍历结束后才替换为index_path，
+      中途中断不会留下不完整的索引。
+    索引为纯文本，每行一个路径，只包含生成时patterns匹配的文件。
+    """
+    if index_path is not None and not refresh and os.path.exists(index_path):
+        matcher = _compile_patterns(patterns)
+        with open(index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                path = line.rstrip('\n')
+                if path and matcher.match(os.path.basename(path)):
+                    yield path
+        return
+
+    if index_path is None:
+        yield from walk_files(root, patterns, workers)
+        return
+
+    tmp_path = index_path + '.tmp'
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for path in walk_files(root, patterns, workers):
+            f.write(path + '\n')
+            yield path
+    os.replace(tmp_path, index_path)
@@ -1,12 +1,49 @@
-import glob 
 import json 
-import pandas as pd 
 import argparse 
+import itertools
+from collections import Counter, namedtuple
 import os
-from concurrent.futures import ThreadPoolExecutor
-import threading 
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from discover import discover_files
+from catalog import TrajectoryCatalog, select_final_samples
+from tool_args import parse_tool_arguments
+from refine_store import RefinementStore, refinement_key
+from writer import TrajectoryWriter, DropWriter
+from report import load_traj_infos, summarize, write_report, print_report
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tool_normalizer import normalize_tool_text
+from token_budget import TokenBudget, POLICIES, DEFAULT_TOKENIZER
 
 MAX_LENGTH = 32768
+MIN_TOOL_CALLS = 3
+parallel = True
+REFINE_PROMPT_VERSION = 'v2'  # 修改refine/enrich的prompt或后处理时需更新，缓存中旧版本的结果随之失效
+refinement_store = None
+token_budget = None  # TokenBudget；为None时不统计token数，只用元数据中的num_tokens_all筛选
+prefilter_max_length = MAX_LENGTH  # 元数据阶段的num_tokens_all上限；按SFT模型的tokenizer裁剪超长轨迹时为None，交给fit阶段处理
+
+# 被丢弃的轨迹：stage为所在阶段，reason为用于统计的类别，detail为具体信息
+Drop = namedtuple('Drop', ['path', 'stage', 'reason', 'detail'])
+
+class TrajectoryDropped(Exception):
+    """轨迹不可用，由run_stage转换为Drop记录"""
+    def __init__(self, reason, detail=''):
+        super().__init__(f'{reason}: {detail}')
+        self.reason = reason
+        self.detail = detail
+
+def run_stage(stage, func, case_result_file, *args):
+    """执行一个阶段；轨迹不可用或出错时返回Drop记录，而不是让异常中断整个任务"""
+    try:
+        return func(*args)
+    except TrajectoryDropped as e:
+        return Drop(case_result_file, stage, e.reason, e.detail)
+    except Exception as e:
+        return Drop(case_result_file, stage, type(e).__name__, str(e)[:500])
+
 def is_mostly_chinese(x: str) -> bool:
     """
     判断字符串中中文汉字数量是否超过英文单词数量的一半
@@ -34,52 +71,10 @@ def is_mostly_chinese(x: str) -> bool:
     # 判断汉字数量是否超过英文单词数量的一半
     return chinese_count > (english_count / 2)
 
-parser = argparse.ArgumentParser(description="可视化parquet文件数据")
-parser.add_argument("file_path", help="parquet文件路径")
-
-args = parser.parse_args()
-
-traj_path = args.file_path 
-#'/root/wxt/traj_zhanghe/output_filter_pipeline_input_ww_dr_mix_v1_sp_v13_attc'
-#'/root/wxt/traj_zhanghe/output_filter_pipeline_input_xintao_reverse_v1_sp_v13_attc'
-#'/Users/bytedance/sft_traj/filter_pipeline_input_webgptv3_from_zehui'
-output_traj_path = f'./filtered_traj/{traj_path.split("/")[-1]}-{MAX_LENGTH}-refined_v2.json'
-
-# 查找函数（支持通配符）
-def find_local_files_glob(local_path, pattern):
-    return (glob.glob(f"{local_path}/**/{pattern}", recursive=True))
-
-# 查找目标文件
-case_result_json_files = find_local_files_glob(traj_path, 'case_result.json')
-parquet_files = find_local_files_glob(traj_path, '*.parquet')
-
-print(f'Num Case Result Files {len(case_result_json_files)}')
-
-all_messages = []
-all_traj_infos = []
-
-# Thread-safe locks for shared data
-messages_lock = threading.Lock()
-traj_infos_lock = threading.Lock()
-
-def process_case_result(case_result_file):
-    with open(case_result_file, 'r') as f:
-        case_result = json.load(f)
-    
+def load_trajectory(case_result_file, final_sample_idx, traj_infos):
+    """阶段2：读取最终sample的消息文件并规范化，拆出第一条thinking；轨迹不可用时返回None"""
     # 如果是case_result.json文件，如 /root/wxt/traj_old/output_filter_pipeline_input_xintao_reverse_v1_sp_v13_attc/00/38/2984/case_result.json
-    # step 1：找到 "final_sample_idx"，读取
-
-    final_sample_idx = case_result.get('final_sample_idx')
-
-    # step 2: 如果"final_sample_idx"不是None，说明有需要的sample，读取case_result_file.replace('case_result', f'{final_sample_idx}_agent')
-    if final_sample_idx is None: return 
-
-    traj_infos = case_result.get('traj_infos', {})
-    traj_infos = {_['sample_idx']: _ for _ in traj_infos}[final_sample_idx]
-
-    if traj_infos['num_tokens_all'] > MAX_LENGTH or traj_infos['num_tool_calls'] < 3: 
-        return 
-
+    # "final_sample_idx"不是None，说明有需要的sample，读取case_result_file.replace('case_result', f'{final_sample_idx}_agent')
     message_file = case_result_file.replace('case_result', f'{final_sample_idx}_agent')
     with open(message_file, 'r') as f:
         message_data = json.load(f)
@@ -108,7 +103,10 @@ def process_case_result(case_result_file):
                 tool_call_records = {}
 
                 for tool_call in m['tool_calls']:
-                    tool_call_ = {"name": tool_call['function']["name"], "parameters": eval(tool_call['function']["arguments"])} 
+                    parameters, error = parse_tool_arguments(tool_call['function']["arguments"])
+                    if error is not None:
+                        raise TrajectoryDropped('malformed_tool_arguments', f'{tool_call["function"]["name"]}: {error}')
+                    tool_call_ = {"name": tool_call['function']["name"], "parameters": parameters} 
                     tool_calls.append(tool_call_)
                     tool_call_records[tool_call['id']] = tool_call_
                 
@@ -121,11 +119,7 @@ def process_case_result(case_result_file):
             tool_message = m['content']
 
             orig_tool_message = tool_message
-            import re
-            tool_message = re.sub(r'(\[发布时间\] \d{4})年(\d{1,2})月(\d{1,2})日', r'\1-\2-\3', tool_message)
-            tool_message = tool_message.replace("[发布时间] 无", "[publish_time] None")
-            for zh_word, en_word in [('[摘要]', '[summary]'), ('[标题]', '[title]'), ('[序号]', '[number]'), ('[发布时间]', '[publish_time]'), ('[来源]', '[source]'), ('（星期一）', '(Monday)'), ('（星期二）', '(Tuesday)'), ('（星期三）', '(Wednesday)'), ('（星期四）', '(Thursday)'), ('（星期五）', '(Friday)'), ('（星期六）', '(Saturday)'), ('（星期日）', '(Sunday)'),]:
-                tool_message = tool_message.replace(zh_word, en_word)
+            tool_message = normalize_tool_text(tool_message)
             
             tool_input = tool_call_records[m['tool_call_id']]
             tool_message = 'tool call: ' + json.dumps(tool_input, ensure_ascii=False)  + '\n' + tool_message
@@ -138,8 +132,33 @@ def process_case_result(case_result_file):
     try:
         thinking_content, tool_call = messages[2]['content'].split('</think>')
         thinking_content = thinking_content.replace('<think>', '')
-    except:
-        return 
+    except ValueError:
+        raise TrajectoryDropped('no_first_thought', 'first assistant message is not <think>...</think>tool_call')
+
+    return {'messages': messages, 'traj_infos': traj_infos, 'question': q, 'language': language,
+            'thinking_content': thinking_content, 'tool_call': tool_call}
+
+
+def refine_first_thought(trajectory):
+    """阶段3：两次LLM调用（seed推断、claude-4-sonnet补全）改写第一条thinking，返回 (messages, traj_infos)"""
+    messages = trajectory['messages']
+    traj_infos = trajectory['traj_infos']
+    q = trajectory['question']
+    language = trajectory['language']
+    thinking_content = trajectory['thinking_content']
+    tool_call = trajectory['tool_call']
+
+    all_thoughts = [ m['content'].split('</think>')[0].replace('<think>', '') for m in messages if m['role'] == 'assistant' and '<think>' in m['content']]
+
+    assert (len(all_thoughts) > 1)
+    subsequent_thoughts_str = '\n\nAction: ...\n\nObservation: ...\n\n\n'.join([ f'Step {i+2}:\nThought: ' + t for i, t in enumerate(all_thoughts[1:4])])
+
+    # 内容与prompt版本都未变时直接复用之前的改写结果，不再调用LLM
+    key = refinement_key(q, tool_call, subsequent_thoughts_str, REFINE_PROMPT_VERSION)
+    cached = refinement_store.get(key) if refinement_store is not None else None
+    if cached is not None:
+        messages[2]['content'] = '<think>' + cached['enriched_thought'] + '</think>' + tool_call
+        return messages, traj_infos
 
     sys_prompt = """Your task is to infer a plausible {thinking process} that connects a given {question} to a {tool_call}. The inferred process must meet the following criteria:
 - Logical Coherence: It must clearly and logically explain the reasoning that leads from the {question} to the specific {tool_call}.
@@ -167,6 +186,8 @@ Thinking Process: {the inferred thinking process}
             return False
 
     response = get_response([ensure_format], model='seed', messages=[{'role': 'user', 'content': sys_prompt}])
+    if response is None:
+        raise TrajectoryDropped('refine_failed', 'no valid seed response')
     refined_thinking_process = response.split('Thinking Process:')[1].strip(' ')
     
     if '===tool_call===' in refined_thinking_process:
@@ -174,10 +195,6 @@ Thinking Process: {the inferred thinking process}
     elif  '<|FunctionCallBegin|>' in refined_thinking_process:
         refined_thinking_process = refined_thinking_process.split('<|FunctionCallBegin|>')[0]
 
-    all_thoughts = [ m['content'].split('</think>')[0].replace('<think>', '') for m in messages if m['role'] == 'assistant' and '<think>' in m['content']]
-
-    assert (len(all_thoughts) > 1)
-    subsequent_thoughts_str = '\n\nAction: ...\n\nObservation: ...\n\n\n'.join([ f'Step {i+2}:\nThought: ' + t for i, t in enumerate(all_thoughts[1:4])])
 
     sys_prompt = """Your task is to check if a proposed {new first thought} is consistent with reasoning steps mentioned later, and enrich it if necessary.
 
@@ -227,7 +244,7 @@ Enriched Thought: {The final, complete version of the thought. If no changes wer
 
     response = get_response([ensure_format2], model='claude-4-sonnet', messages=[{'role': 'user', 'content': sys_prompt}])
     if response is None:
-        return 
+        raise TrajectoryDropped('enrich_failed', 'no valid claude-4-sonnet response')
 
     _, enriched_thinking_process = response.split('Enriched Thought:')
     need_enrichment = _.split('Need Enrichment:')[-1].strip(' \n').lower()
@@ -242,6 +259,8 @@ Enriched Thought: {The final, complete version of the thought. If no changes wer
         enriched_thinking_process = enriched_thinking_process.split('<|FunctionCallBegin|>')[0]
 
     final_assistant_message = '<think>' + enriched_thinking_process + '</think>' + tool_call
+    if refinement_store is not None:
+        refinement_store.put(key, REFINE_PROMPT_VERSION, refined_thinking_process, enriched_thinking_process, need_enrichment == 'true')
 
     print('\n\n=====Final Thinking Process=====\n\n', final_assistant_message)
     print('\n\n=====Full Enrich Response=====\n\n', response)
@@ -254,46 +273,230 @@ Enriched Thought: {The final, complete version of the thought. If no changes wer
     return messages, traj_infos
 
 
-# Use ThreadPoolExecutor to process files in parallel
-if 1:
-    with ThreadPoolExecutor(max_workers=40) as executor:
-        futures = []
-        for j, case_result_file in enumerate(case_result_json_files):
-            future = executor.submit(process_case_result, case_result_file)
-            futures.append(future)
-        
-        # Wait for all tasks to complete and collect results
-        for future in futures:
-            result = future.result()
-            if result is not None:
-                messages, traj_infos = result
-                all_messages.append({'messages': messages})
-                all_traj_infos.append(traj_infos)
-else:
-    # not parallel 
-    for j, case_result_file in enumerate(case_result_json_files):
-        result = process_case_result(case_result_file)
-        if result is not None:
-            messages, traj_infos = result
-            all_messages.append({'messages': messages})
-            all_traj_infos.append(traj_infos)
-    
+def fit_to_budget(messages, traj_infos):
+    """按最终内容统计每条消息的token数，超长时按token_budget的策略裁剪，返回 (messages, traj_infos)"""
+    if token_budget is None:
+        return messages, traj_infos
+    messages, info = token_budget.fit(messages)
+    if messages is None:
+        raise TrajectoryDropped('over_length', info)
+    return messages, dict(traj_infos, num_tokens_fitted=info['num_tokens'], num_truncated_messages=info['num_truncated'])
 
-with open(output_traj_path, 'w') as f:
-    json.dump(all_messages, f, ensure_ascii=False, indent=2)
 
-df = pd.DataFrame(all_messages)
-df.to_parquet(output_traj_path.replace('.json', '.parquet'))
+def load_and_fit(case_result_file, final_sample_idx, traj_infos):
+    """阶段2：读取并裁剪，无法裁剪到MAX_LENGTH以内的轨迹在这里丢弃，不再调用LLM"""
+    trajectory = run_stage('load', load_trajectory, case_result_file, case_result_file, final_sample_idx, traj_infos)
+    if isinstance(trajectory, Drop):
+        return trajectory
+    fitted = run_stage('fit', fit_to_budget, case_result_file, trajectory['messages'], trajectory['traj_infos'])
+    if isinstance(fitted, Drop):
+        return fitted
+    trajectory['messages'], trajectory['traj_infos'] = fitted
+    return trajectory
 
-# 统计traj_infos
-print('total num: ', len(all_traj_infos))
-if all_traj_infos:
-    for k in all_traj_infos[0].keys():
-        all_values = [_.get(k) for _ in all_traj_infos]
-        max_value = max(all_values)
-        avg_value = sum(all_values) / len(all_values)
-        min_value = min(all_values)
-        print(f'{k} max: {max_value} avg: {avg_value} min: {min_value}')
 
+def refine_and_fit(case_result_file, trajectory):
+    """阶段3：改写第一条thinking；改写改变了该消息的长度，按最终内容重新统计并裁剪"""
+    result = run_stage('refine', refine_first_thought, case_result_file, trajectory)
+    if isinstance(result, Drop):
+        return result
+    return run_stage('fit', fit_to_budget, case_result_file, *result)
 
 
+def run_pipeline(tasks, on_result, on_drop, metadata_workers=None, load_workers=16, llm_workers=40, batch_size=256):
+    """
+    三阶段流水线，磁盘读取和LLM调用不再占用同一批线程：
+    1. 进程池中只读取case_result.json做元数据筛选（tasks中已带有筛选结果的跳过此阶段）；
+    2. 线程池中为通过筛选的轨迹读取消息文件、规范化并按token_budget裁剪；
+    3. 单独的线程池中做LLM改写并重新裁剪，并发数由llm_workers限制；
+       已加载、尚未写出的轨迹最多2 * llm_workers条，读取线程在此阻塞，读取不会远远领先于LLM。
+    tasks为 [(case_result_file, (final_sample_idx, traj_infos)或None)]，所有阶段的future在同一个循环中按完成顺序处理，
+    各阶段边完成边提交下一阶段。
+    任一阶段不可用的轨迹记为Drop并立即在当前线程调用 on_drop(drop)，不会中断其余任务。
+    每条改写完成的轨迹按完成顺序在当前线程调用 on_result(case_result_file, messages, traj_infos)，结果不在内存中累积。
+    返回各阶段的统计
+    """
+    stats = {'files': 0, 'selected': 0, 'loaded': 0, 'refined': 0}
+    dropped = Counter()
+
+    def drop(record):
+        dropped[record.reason] += 1
+        on_drop(record)
+
+    with ProcessPoolExecutor(max_workers=metadata_workers) as metadata_pool, \
+            ThreadPoolExecutor(max_workers=load_workers) as load_pool, \
+            ThreadPoolExecutor(max_workers=llm_workers) as llm_pool:
+
+        # 已加载、尚未写出的轨迹数上限：LLM阶段较慢，不限制时读取线程会把全部轨迹堆进llm_pool的队列
+        # 名额在主线程写出（或丢弃）该轨迹后才归还，已完成未写出的结果同样计入
+        llm_slots = threading.BoundedSemaphore(2 * llm_workers)
+
+        def load_then_refine(case_result_file, final_sample_idx, traj_infos):
+            trajectory = load_and_fit(case_result_file, final_sample_idx, traj_infos)
+            if isinstance(trajectory, Drop):
+                return trajectory
+            llm_slots.acquire()
+            return llm_pool.submit(refine_and_fit, case_result_file, trajectory)
+
+        # 各阶段进行中的future -> (阶段, case_result_file)，在同一个循环中按完成顺序处理
+        pending = {}
+
+        def submit_loads(selected):
+            stats['selected'] += len(selected)
+            for i, case_result_file, final_sample_idx, traj_infos in selected:
+                pending[load_pool.submit(load_then_refine, case_result_file, final_sample_idx, traj_infos)] = ('load', case_result_file)
+
+        def handle(future):
+            stage, case_result_file = pending.pop(future)
+            if stage == 'metadata':
+                selected, errors = future.result()
+                for path, error in errors:
+                    drop(Drop(path, 'metadata', 'unreadable_case_result', error))
+                submit_loads(selected)
+            elif stage == 'load':
+                llm_future = future.result()
+                if isinstance(llm_future, Drop):
+                    drop(llm_future)
+                    return
+                stats['loaded'] += 1
+                pending[llm_future] = ('llm', case_result_file)
+            else:
+                result = future.result()
+                llm_slots.release()
+                if isinstance(result, Drop):
+                    drop(result)
+                    return
+                stats['refined'] += 1
+                # 改写完成即写出，future随之释放，结果不在内存中累积
+                on_result(case_result_file, *result)
+
+        indexed_tasks = enumerate(tasks)
+        discovering = True
+        while discovering or pending:
+            if discovering:
+                batch = list(itertools.islice(indexed_tasks, batch_size))
+                if not batch:
+                    discovering = False
+                    continue
+                stats['files'] += len(batch)
+                submit_loads([(i, path, *selected) for i, (path, selected) in batch if selected is not None])
+                unselected = [(i, path) for i, (path, selected) in batch if selected is None]
+                if unselected:
+                    pending[metadata_pool.submit(select_final_samples, unselected, prefilter_max_length, MIN_TOOL_CALLS)] = ('metadata', None)
+                # 边发现文件边处理已完成的各阶段，不等待
+                done = [future for future in pending if future.done()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle(future)
+
+    stats['dropped'] = dict(dropped)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="可视化parquet文件数据")
+    parser.add_argument("file_path", help="parquet文件路径")
+    parser.add_argument("--scan-workers", type=int, default=16, help="并行扫描目录的线程数")
+    parser.add_argument("--file-index", default=None, help="文件列表索引路径：存在时直接读取，否则遍历后写入，供重复运行使用")
+    parser.add_argument("--refresh-index", action="store_true", help="忽略已有的文件列表索引，重新遍历")
+    parser.add_argument("--catalog", default=None, help="轨迹目录数据库路径：增量索引case_result.json后按阈值查询，不再每次重新读取")
+    parser.add_argument("--metadata-workers", type=int, default=None, help="阶段1元数据筛选的进程数，默认为CPU数")
+    parser.add_argument("--load-workers", type=int, default=16, help="阶段2读取消息文件的线程数")
+    parser.add_argument("--llm-workers", type=int, default=40, help="阶段3 LLM改写的并发数")
+    parser.add_argument("--refine-cache", default='./filtered_traj/refinements.db', help="第一条thinking改写结果的缓存路径，空字符串表示不使用")
+    parser.add_argument("--resume", action="store_true", help="保留已有的JSONL输出，跳过其中已完成的轨迹继续运行")
+    parser.add_argument("--row-group-size", type=int, default=1000, help="Parquet输出每个row group的轨迹数")
+    parser.add_argument("--truncate-policy", choices=POLICIES, default='truncate_tool', help="超过MAX_LENGTH时的处理：drop丢弃，truncate_tool截短tool消息")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER, help="SFT模型的HF tokenizer路径（与token上限口径一致）；未提供时退回tiktoken编码，计数与实际可能相差较多，并保留按预先计算长度的筛选")
+
+    args = parser.parse_args()
+
+    global refinement_store, token_budget, prefilter_max_length
+    token_budget = TokenBudget(MAX_LENGTH, policy=args.truncate_policy, tokenizer=args.tokenizer)
+    # 只有按SFT模型自身的tokenizer计数时才放开num_tokens_all的筛选，tiktoken的计数只是近似
+    if args.truncate_policy != 'drop' and token_budget.uses_model_tokenizer:
+        prefilter_max_length = None
+    if args.refine_cache:
+        os.makedirs(os.path.dirname(os.path.abspath(args.refine_cache)), exist_ok=True)
+        refinement_store = RefinementStore(args.refine_cache)
+
+    traj_path = args.file_path 
+    #'/root/wxt/traj_zhanghe/output_filter_pipeline_input_ww_dr_mix_v1_sp_v13_attc'
+    #'/root/wxt/traj_zhanghe/output_filter_pipeline_input_xintao_reverse_v1_sp_v13_attc'
+    #'/Users/bytedance/sft_traj/filter_pipeline_input_webgptv3_from_zehui'
+    output_traj_path = f'./filtered_traj/{traj_path.split("/")[-1]}-{MAX_LENGTH}-refined_v2.jsonl'
+    writer = TrajectoryWriter(output_traj_path, output_traj_path.replace('.jsonl', '.parquet'),
+                              row_group_size=args.row_group_size, resume=args.resume)
+    if writer.done:
+        print(f'Resuming: {len(writer.done)} trajectories already in {output_traj_path}')
+
+    # 单次并行遍历同时查找case_result.json和parquet文件，边发现边处理
+    discovered_files = discover_files(traj_path, ['case_result.json', '*.parquet'], workers=args.scan_workers,
+                                      index_path=args.file_index, refresh=args.refresh_index)
+    case_result_json_files = []
+    parquet_files = []
+
+    def iter_case_result_files():
+        for path in discovered_files:
+            if path.endswith('.parquet'):
+                parquet_files.append(path)
+            else:
+                case_result_json_files.append(path)
+                yield path
+
+    if args.catalog:
+        # 先增量更新目录（只读取新增或变化的case_result.json），再按阈值查询
+        catalog = TrajectoryCatalog(args.catalog)
+        catalog_stats = catalog.update(iter_case_result_files(), root=traj_path)
+        print(f'Num Case Result Files {len(case_result_json_files)}, catalog update: {catalog_stats}')
+        tasks = [(path, (final_sample_idx, traj_infos))
+                 for path, final_sample_idx, traj_infos in catalog.select(prefilter_max_length, MIN_TOOL_CALLS, root=traj_path)]
+        print(f'Num Selected {len(tasks)}')
+    else:
+        tasks = ((case_result_file, None) for case_result_file in iter_case_result_files())
+
+    # 被丢弃的轨迹及原因，边发生边写出，每行一条；续跑时追加，已记录的轨迹不再处理
+    drop_writer = DropWriter(output_traj_path.replace('.jsonl', '-drops.jsonl'), resume=args.resume)
+    if drop_writer.done:
+        print(f'Resuming: {len(drop_writer.done)} dropped trajectories already in {drop_writer.jsonl_path}')
+
+    # 续跑时跳过已写出或已丢弃的轨迹
+    tasks = ((path, selected) for path, selected in tasks if path not in writer.done and path not in drop_writer.done)
+
+    if parallel:
+        with writer, drop_writer:
+            stats = run_pipeline(tasks, writer.write, drop_writer.write, metadata_workers=args.metadata_workers, load_workers=args.load_workers, llm_workers=args.llm_workers)
+        print(f'Num Case Result Files {len(case_result_json_files)}, pipeline: {stats}')
+    else:
+        # not parallel 
+        with writer, drop_writer:
+            for case_result_file, selected in tasks:
+                if selected is None:
+                    selected, errors = select_final_samples([(0, case_result_file)], prefilter_max_length, MIN_TOOL_CALLS)
+                    for path, error in errors:
+                        drop_writer.write(Drop(path, 'metadata', 'unreadable_case_result', error))
+                    if not selected:
+                        continue
+                    selected = selected[0][2:]
+                result = load_and_fit(case_result_file, *selected)
+                if not isinstance(result, Drop):
+                    result = refine_and_fit(case_result_file, result)
+                if isinstance(result, Drop):
+                    drop_writer.write(result)
+                else:
+                    writer.write(case_result_file, *result)
+
+    print(f'written: {writer.written} new, {len(writer.done)} total in {output_traj_path}')
+    print('dropped: ', dict(drop_writer.reasons))
+    if refinement_store is not None:
+        print(f'refinement cache: {refinement_store.hits} hits, {refinement_store.misses} misses')
+
+    # 统计traj_infos（包括续跑前已写出的轨迹），汇总写入-report.json
+    summary = summarize(load_traj_infos(output_traj_path))
+    write_report(summary, output_traj_path.replace('.jsonl', '-report.json'))
+    print_report(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def refinement_key(question, tool_call, subsequent_thoughts, prompt_version):
+    """改写结果只取决于问题、第一次工具调用、后续thinking和prompt版本，以它们的哈希为key"""
+    payload = json.dumps([prompt_version, question, tool_call, subsequent_thoughts], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RefinementStore:
+    """
+    第一条thinking改写结果的缓存：按refinement_key保存seed推断的thinking、
+    claude-4-sonnet补全后的thinking以及是否需要补全。
+
+    重复运行时内容未变的轨迹直接复用结果，两次LLM调用都不再发出；
+    修改prompt时更新prompt版本，旧版本的结果不会再被命中。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS refinements (
+            key TEXT PRIMARY KEY,
+            prompt_version TEXT NOT NULL,
+            refined_thought TEXT NOT NULL,
+            enriched_thought TEXT NOT NULL,
+            need_enrichment INTEGER NOT NULL,
+            created_at REAL
+        )''')
+
+    def _conn(self):
+        # sqlite3连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """命中时返回 {refined_thought, enriched_thought, need_enrichment}，否则返回None"""
+        row = self._conn().execute(
+            'SELECT refined_thought, enriched_thought, need_enrichment FROM refinements WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        return {'refined_thought': row['refined_thought'], 'enriched_thought': row['enriched_thought'],
+                'need_enrichment': bool(row['need_enrichment'])}
+
+    def put(self, key, prompt_version, refined_thought, enriched_thought, need_enrichment):
+        self._conn().execute('INSERT OR REPLACE INTO refinements VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, prompt_version, refined_thought, enriched_thought, int(need_enrichment), time.time()))
+
+    def prune(self, prompt_version):
+        """删除其他prompt版本的结果，返回删除的条数"""
+        return self._conn().execute('DELETE FROM refinements WHERE prompt_version != ?', (prompt_version,)).rowcount
@@ -0,0 +1,109 @@
+import argparse
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+PERCENTILES = [0.5, 0.9, 0.95, 0.99]
+HISTOGRAM_BINS = 20
+
+
+def load_traj_infos(jsonl_path):
+    """
+    逐行读取TrajectoryWriter写出的JSONL，只保留traj_infos、路径和语言，返回DataFrame（每条轨迹一行）。
+    语言按用户问题（messages[1]）判断，规则与is_mostly_chinese相同：汉字数 > 英文单词数/2 为zh。
+    """
+    rows = []
+    queries = []
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            rows.append(dict(record.get('traj_infos') or {}, path=record.get('path')))
+            messages = record.get('messages') or []
+            queries.append(messages[1]['content'] if len(messages) > 1 else '')
+
+    df = pd.DataFrame.from_records(rows)
+    queries = pd.Series(queries, index=df.index, dtype='object')
+    chinese_count = queries.str.count(r'[\u4e00-\u9fff]')
+    english_count = queries.str.count(r'[a-zA-Z]+')
+    df['language'] = np.where(english_count == 0, np.where(chinese_count > 0, 'zh', 'en'),
+                              np.where(chinese_count > english_count / 2, 'zh', 'en'))
+    return df
+
+
+def _to_builtin(value):
+    """numpy标量转为Python类型，NaN转为None，便于写JSON"""
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return None if math.isnan(value) else float(value)
+    return value
+
+
+def _describe(frame):
+    """各数值列的count/missing/mean/std/min/百分位/max；None计为缺失，不参与计算"""
+    described = frame.describe(percentiles=PERCENTILES).T
+    described.insert(1, 'missing', frame.isna().sum())
+    return {column: {stat: _to_builtin(value) for stat, value in row.items()}
+            for column, row in described.to_dict('index').items()}
+
+
+def summarize(df, bins=HISTOGRAM_BINS):
+    """
+    一次向量化计算traj_infos的汇总：整体的分布统计、各数值列的直方图，以及按语言分组的分布统计。
+    返回可直接写为JSON的dict。
+    """
+    numeric = df.drop(columns=['path', 'language'], errors='ignore').apply(pd.to_numeric, errors='coerce')
+    numeric = numeric.loc[:, numeric.notna().any()]
+
+    histograms = {}
+    for column in numeric.columns:
+        values = numeric[column].dropna().to_numpy()
+        counts, edges = np.histogram(values, bins=bins)
+        histograms[column] = {'edges': [_to_builtin(e) for e in edges], 'counts': counts.tolist()}
+
+    by_language = {}
+    if 'language' in df:
+        for language, group in numeric.groupby(df['language']):
+            by_language[language] = {'count': int(len(group)), 'metrics': _describe(group)}
+
+    return {
+        'count': int(len(df)),
+        'metrics': _describe(numeric) if len(numeric.columns) else {},
+        'histograms': histograms,
+        'by_language': by_language,
+    }
+
+
+def write_report(summary, report_path):
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+def print_report(summary):
+    print('total num: ', summary['count'])
+    for k, stats in summary['metrics'].items():
+        print(f"{k} max: {stats['max']} avg: {stats['mean']} min: {stats['min']} "
+              f"p50: {stats['50%']} p90: {stats['90%']} p99: {stats['99%']} missing: {stats['missing']}")
+    for language, group in summary['by_language'].items():
+        print(f"[{language}] num: {group['count']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="汇总filter_traj输出JSONL中的traj_infos，多个文件时便于对比不同的筛选结果")
+    parser.add_argument("jsonl_paths", nargs='+', help="filter_traj/main.py写出的JSONL")
+    parser.add_argument("--output", default=None, help="汇总JSON的输出路径，默认为各JSONL旁的-report.json")
+    parser.add_argument("--bins", type=int, default=HISTOGRAM_BINS, help="直方图的分箱数")
+    args = parser.parse_args()
+
+    reports = {}
+    for jsonl_path in args.jsonl_paths:
+        summary = summarize(load_traj_infos(jsonl_path), bins=args.bins)
+        print(f'===== {jsonl_path} =====')
+        print_report(summary)
+        reports[jsonl_path] = summary
+        if args.output is None:
+            write_report(summary, jsonl_path.replace('.jsonl', '-report.json'))
+    if args.output is not None:
+        write_report(reports, args.output)
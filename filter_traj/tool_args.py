@@ -0,0 +1,27 @@
+import ast
+import json
+
+
+def parse_tool_arguments(arguments):
+    """
+    解析工具调用的arguments，不执行任何代码（替代eval）。
+    先按JSON解析；失败时用ast.literal_eval兼容Python字面量写法（单引号、True/None等）。
+
+    返回 (参数dict, None)；无法解析或解析结果不是对象时返回 (None, 原因)。
+    """
+    if isinstance(arguments, dict):
+        return arguments, None
+    if not isinstance(arguments, str):
+        return None, f'arguments is {type(arguments).__name__}, not a string'
+
+    try:
+        value = json.loads(arguments)
+    except json.JSONDecodeError as json_error:
+        try:
+            value = ast.literal_eval(arguments.strip())
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError) as literal_error:
+            return None, f'neither JSON ({json_error.msg}) nor a Python literal ({type(literal_error).__name__}): {arguments[:200]!r}'
+
+    if not isinstance(value, dict):
+        return None, f'arguments is a {type(value).__name__}, not an object'
+    return value, None
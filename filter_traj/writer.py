@@ -0,0 +1,144 @@
+import json
+import os
+from collections import Counter
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MESSAGE_TYPE = pa.struct([
+    ('role', pa.string()),
+    ('content', pa.string()),
+    ('loss_mask', pa.float64()),
+    ('name', pa.string()),
+])
+PARQUET_SCHEMA = pa.schema([
+    ('path', pa.string()),
+    ('messages', pa.list_(MESSAGE_TYPE)),
+])
+
+
+def _recover_jsonl(jsonl_path):
+    """
+    读取已有的JSONL输出，返回其中已完成的case_result路径集合。
+    上次运行中断时最后一行可能不完整，将文件截断到最后一个完整行。
+    """
+    done = set()
+    if not os.path.exists(jsonl_path):
+        return done
+    valid_bytes = 0
+    with open(jsonl_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(json.loads(line)['path'])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(jsonl_path):
+        with open(jsonl_path, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return done
+
+
+class TrajectoryWriter:
+    """
+    边完成边写出轨迹：每条轨迹立即追加到JSONL（{path, messages, traj_infos}，每行一条并flush），
+    同时按row_group_size条一组写入Parquet（path、messages两列），内存中最多只保留一个row group。
+
+    JSONL是可恢复的主输出：resume为True时保留已有的JSONL，done为其中已完成的路径，调用方跳过这些轨迹即可续跑。
+    Parquet不能追加，写入 parquet_path + '.tmp'：续跑时先把已有JSONL按批转写进去，
+    close()时才替换为parquet_path，中途中断不会留下不完整的Parquet。
+    """
+
+    def __init__(self, jsonl_path, parquet_path, row_group_size=1000, resume=False):
+        self.jsonl_path = jsonl_path
+        self.parquet_path = parquet_path
+        self.row_group_size = row_group_size
+        self.done = _recover_jsonl(jsonl_path) if resume else set()
+        self.written = 0
+        self._rows = []
+
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+        self._parquet = pq.ParquetWriter(parquet_path + '.tmp', PARQUET_SCHEMA)
+        if self.done:
+            with open(jsonl_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self._add_row(record['path'], record['messages'])
+        self._jsonl = open(jsonl_path, 'a' if resume else 'w', encoding='utf-8')
+
+    def _add_row(self, path, messages):
+        self._rows.append({'path': path, 'messages': messages})
+        if len(self._rows) >= self.row_group_size:
+            self._flush_rows()
+
+    def _flush_rows(self):
+        if self._rows:
+            self._parquet.write_table(pa.Table.from_pylist(self._rows, schema=PARQUET_SCHEMA))
+            self._rows = []
+
+    def write(self, path, messages, traj_infos):
+        self._jsonl.write(json.dumps({'path': path, 'messages': messages, 'traj_infos': traj_infos}, ensure_ascii=False) + '\n')
+        self._jsonl.flush()
+        self._add_row(path, messages)
+        self.done.add(path)
+        self.written += 1
+
+    def close(self):
+        self._jsonl.close()
+        self._flush_rows()
+        self._parquet.close()
+        os.replace(self.parquet_path + '.tmp', self.parquet_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # 出错时只保证JSONL完整，不完整的Parquet留在.tmp中，续跑时会重新生成
+            self._jsonl.close()
+            self._parquet.close()
+        return False
+
+
+class DropWriter:
+    """
+    边发生边写出被丢弃的轨迹：每条Drop立即追加为一行 {path, stage, reason, detail} 并flush，中途中断不丢失已记录的Drop。
+    resume为True时保留已有的文件，done为其中已记录的路径，调用方跳过这些轨迹；同一路径不会重复写入。
+    """
+
+    def __init__(self, jsonl_path, resume=False):
+        self.jsonl_path = jsonl_path
+        self.done = _recover_jsonl(jsonl_path) if resume else set()
+        self.reasons = Counter()
+
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+        self._jsonl = open(jsonl_path, 'a' if resume else 'w', encoding='utf-8')
+
+    def write(self, drop):
+        if drop.path in self.done:
+            return
+        self._jsonl.write(json.dumps(drop._asdict(), ensure_ascii=False) + '\n')
+        self._jsonl.flush()
+        self.done.add(drop.path)
+        self.reasons[drop.reason] += 1
+
+    def close(self):
+        self._jsonl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def iter_jsonl(jsonl_path):
+    """逐条读取TrajectoryWriter写出的JSONL"""
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,66 @@
+"""
+import utils的开销检查：防止延迟初始化退化。
+
+在一个空的临时目录中（没有config.json）用新的解释器执行 python -X importtime -c "import utils"，检查：
+- 能成功import，且没有创建日志文件（说明import时没有读取配置、初始化日志）；
+- openai、requests、tiktoken都没有被import；
+- utils的累计import耗时不超过预算。
+
+用法: python check_import_time.py [--budget-ms 200] [--repeat 3]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ('openai', 'requests', 'tiktoken')
+_IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)')
+
+def measure_import(module='utils'):
+	"""在新进程中import module，返回 (累计耗时ms, 被import的全部模块名, 运行后临时目录中的文件)"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	with tempfile.TemporaryDirectory() as cwd:
+		env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get('PYTHONPATH', ''))
+		proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+			cwd=cwd, env=env, capture_output=True, text=True)
+		if proc.returncode != 0:
+			raise AssertionError(f'import {module} failed in an empty directory:\n{proc.stderr[-2000:]}')
+		created = os.listdir(cwd)
+
+	cumulative_us = None
+	imported = set()
+	for line in proc.stderr.splitlines():
+		m = _IMPORTTIME_LINE.match(line)
+		if m is None:
+			continue
+		name = m.group(3)
+		imported.add(name)
+		if name == module:
+			cumulative_us = int(m.group(2))
+	if cumulative_us is None:
+		raise AssertionError(f'no importtime entry for {module}')
+	return cumulative_us / 1000, imported, created
+
+def check(budget_ms=200, repeat=3):
+	timings = []
+	for _ in range(repeat):
+		elapsed_ms, imported, created = measure_import('utils')
+		heavy = sorted(name for name in imported if name.split('.')[0] in HEAVY_MODULES)
+		assert not heavy, f'import utils pulled in {heavy}'
+		assert not created, f'import utils created {created} in the working directory'
+		timings.append(elapsed_ms)
+	# 取最快的一次，排除冷缓存等偶发抖动
+	best = min(timings)
+	assert best <= budget_ms, f'import utils took {best:.1f}ms > budget {budget_ms}ms'
+	return best
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="检查import utils是否保持延迟初始化且在耗时预算内")
+	parser.add_argument("--budget-ms", type=float, default=200, help="utils累计import耗时的上限（毫秒）")
+	parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快的一次")
+	args = parser.parse_args()
+
+	best = check(args.budget_ms, args.repeat)
+	print(f'OK: import utils {best:.1f}ms <= {args.budget_ms}ms, none of {", ".join(HEAVY_MODULES)} imported')
@@ -0,0 +1,162 @@
+import math
+import re
+import unicodedata
+import numpy as np
+from knowledge import wiki_id_of
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+def normalize_text(text):
+	"""NFKC + casefold，标点和空白统一为单个空格；非字符串（如NaN）视为空串"""
+	if not isinstance(text, str):
+		return ''
+	text = unicodedata.normalize('NFKC', text).casefold()
+	return _NON_WORD.sub(' ', text).strip()
+
+def entity_text(entity):
+	return (normalize_text(entity.get('label')) + ' ' + normalize_text(entity.get('description'))).strip()
+
+def minhash_signatures(texts, num_perm=64, k=3, seed=1, chunk_rows=200000):
+	"""
+	字符k-gram的MinHash签名，返回 (len(texts), num_perm) 的uint32数组。
+	k-gram哈希与min都按整块数组计算，不在Python中逐个k-gram循环。
+	"""
+	rng = np.random.RandomState(seed)
+	a = rng.randint(1, 2 ** 62, size=num_perm, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+	b = rng.randint(0, 2 ** 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+	sigs = np.empty((len(texts), num_perm), dtype=np.uint32)
+	for start in range(0, len(texts), chunk_rows):
+		# 短于k的文本补空格，保证每条至少有一个k-gram
+		chunk = [t.ljust(k) for t in texts[start:start + chunk_rows]]
+		lengths = np.fromiter(map(len, chunk), dtype=np.int64, count=len(chunk))
+		ends = np.cumsum(lengths)
+		cps = np.frombuffer(''.join(chunk).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+
+		n_pos = len(cps) - k + 1
+		shingles = np.zeros(n_pos, dtype=np.uint64)
+		for j in range(k):
+			shingles = shingles * np.uint64(1000003) + cps[j:j + n_pos]
+
+		# 去掉跨越两条文本边界的k-gram
+		valid = np.ones(len(cps), dtype=bool)
+		for d in range(1, k):
+			valid[ends - d] = False
+		shingles = shingles[valid[:n_pos]]
+		offsets = ends - lengths - (k - 1) * np.arange(len(chunk))
+
+		for p in range(num_perm):
+			hashed = ((a[p] * shingles + b[p]) >> np.uint64(32)).astype(np.uint32)
+			sigs[start:start + len(chunk), p] = np.minimum.reduceat(hashed, offsets)
+	return sigs
+
+def _band_pairs(sigs, bands):
+	"""LSH分桶：任一band完全相同的条目与桶内第一个条目组成候选对"""
+	rows = sigs.shape[1] // bands
+	pairs = []
+	for band in range(bands):
+		block = np.ascontiguousarray(sigs[:, band * rows:(band + 1) * rows])
+		keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+		_, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+		leader = first[inverse.ravel()]
+		idx = np.flatnonzero(leader != np.arange(len(keys)))
+		pairs.append(np.stack([idx, leader[idx]], axis=1))
+	return np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+
+def _key_pairs(keys):
+	"""相同key（None除外）的条目与第一次出现的条目组成一对"""
+	first_seen = {}
+	pairs = []
+	for i, key in enumerate(keys):
+		if key is None:
+			continue
+		if key in first_seen:
+			pairs.append((i, first_seen[key]))
+		else:
+			first_seen[key] = i
+	return pairs
+
+def find_clusters(entities, threshold=0.8, num_perm=64, bands=16):
+	"""
+	返回重复簇（下标列表，每簇至少2个实体）。
+	WIKI id相同的实体总在同一簇；WIKI id不同（都有效）的实体永远不会被合并到同一簇，
+	如历年举办的同名活动、描述几乎相同的不同人物，相似度再高也只是不同的实体。
+	"""
+	n = len(entities)
+	if n == 0:
+		return []
+
+	wiki_ids = [wiki_id_of(entity) for entity in entities]
+	sigs = minhash_signatures([entity_text(entity) for entity in entities], num_perm=num_perm)
+	pairs = _band_pairs(sigs, bands)
+	# 用签名估计的Jaccard相似度过滤LSH候选，按相似度从高到低合并
+	similarity = (sigs[pairs[:, 0]] == sigs[pairs[:, 1]]).mean(axis=1) if len(pairs) else np.empty(0)
+	keep = similarity >= threshold
+	order = np.argsort(-similarity[keep], kind='stable')
+	# 先合并WIKI id相同的实体，使每个簇的WIKI id确定后再判断相似对能否合并
+	pairs = _key_pairs(wiki_ids) + pairs[keep][order].tolist()
+
+	parent = list(range(n))
+	cluster_wiki_id = list(wiki_ids)  # 以根为下标：簇内的有效WIKI id，没有则为None
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+	for i, j in pairs:
+		ri, rj = find(i), find(j)
+		if ri == rj:
+			continue
+		id_i, id_j = cluster_wiki_id[ri], cluster_wiki_id[rj]
+		if id_i is not None and id_j is not None and id_i != id_j:
+			continue
+		root, child = min(ri, rj), max(ri, rj)
+		parent[child] = root
+		cluster_wiki_id[root] = id_i if id_i is not None else id_j
+
+	clusters = {}
+	for i in range(n):
+		clusters.setdefault(find(i), []).append(i)
+	return [members for members in clusters.values() if len(members) > 1]
+
+def _popularity(entity):
+	try:
+		score = float(entity.get('popularity_score'))
+	except (TypeError, ValueError):
+		return 0.0
+	return 0.0 if math.isnan(score) else score
+
+def _describe(entity):
+	return {'label': entity.get('label'), 'id': str(entity.get('id')), 'description': entity.get('description')}
+
+def deduplicate(entities, reference=(), threshold=0.8):
+	"""
+	在发起LLM调用前对实体做近似去重：label+description归一化后做MinHash + LSH，相同WIKI id也视为重复；
+	WIKI id不同的实体不会被视为重复。
+	每个重复簇只保留一个代表：簇中有reference实体（如已选中的实体）时全部候选都被去掉，
+	否则保留popularity_score最高的候选。
+
+	返回 (保留的实体列表, 重复簇报告)
+	"""
+	reference = list(reference)
+	all_entities = reference + list(entities)
+	n_ref = len(reference)
+
+	dropped = set()
+	report = []
+	for members in find_clusters(all_entities, threshold):
+		refs = [i for i in members if i < n_ref]
+		if len(refs) == len(members):
+			continue
+		if refs:
+			representative = refs[0]
+		else:
+			representative = max(members, key=lambda i: (_popularity(all_entities[i]), -i))
+		dropped.update(i for i in members if i >= n_ref and i != representative)
+		report.append({
+			'representative': _describe(all_entities[representative]),
+			'duplicates': [_describe(all_entities[i]) for i in members if i != representative],
+		})
+
+	kept = [entity for i, entity in enumerate(all_entities[n_ref:], n_ref) if i not in dropped]
+	return kept, report
@@ -0,0 +1,117 @@
+import json
+import os
+from collections import defaultdict
+from utils import cache_get, count_tokens_batch
+
+# 没有历史遥测时使用的默认值
+DEFAULT_PROFILE = {'calls': 0, 'seconds': 60.0, 'completion_tokens': 2000.0, 'failure_rate': 0.0}
+
+def load_model_profiles(path):
+	"""从历史运行的遥测记录中统计各模型的平均延迟、平均输出token数和失败率"""
+	stats = defaultdict(lambda: {'ok': 0, 'failed': 0, 'seconds': 0.0, 'completion_tokens': 0})
+	if os.path.exists(path):
+		with open(path, 'r', encoding='utf-8') as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except json.JSONDecodeError:
+					continue
+				s = stats[record['model']]
+				if record.get('ok'):
+					s['ok'] += 1
+					s['seconds'] += record['seconds']
+					s['completion_tokens'] += record.get('completion_tokens') or 0
+				else:
+					s['failed'] += 1
+
+	profiles = {}
+	for model, s in stats.items():
+		if s['ok'] == 0:
+			continue
+		profiles[model] = {
+			'calls': s['ok'],
+			'seconds': s['seconds'] / s['ok'],
+			'completion_tokens': s['completion_tokens'] / s['ok'],
+			'failure_rate': s['failed'] / (s['ok'] + s['failed']),
+		}
+	return profiles
+
+class RunEstimate:
+	"""
+	累积一次运行计划中的全部模型调用，最后统一用批量编码计算token数，
+	并按历史遥测的吞吐和config中的价格估计成本与耗时。
+
+	对话中尚未生成的回复用int表示（按模型平均输出token数估计）。
+	"""
+
+	def __init__(self, profiles, pricing=None):
+		self.profiles = profiles
+		self.pricing = pricing or {}
+		self.calls = []
+		self.entity_seconds = []
+		self._entity_start = 0
+
+	def profile(self, model):
+		return self.profiles.get(model, DEFAULT_PROFILE)
+
+	def add_call(self, model, messages):
+		"""
+		记录一次调用。若输入完全已知且命中响应缓存，返回缓存中的回复（str）；
+		否则返回该模型回复的估计token数（int）。
+		"""
+		known = all(isinstance(m['content'], str) for m in messages)
+		response = cache_get('_get_response', model=model, messages=messages, nth_generation=0) if known else None
+		self.calls.append({'model': model, 'inputs': [m['content'] for m in messages], 'response': response})
+		if response is not None:
+			return response
+		return int(self.profile(model)['completion_tokens'])
+
+	def end_entity(self):
+		"""标记一个实体的调用结束；同一实体内的调用串行执行"""
+		calls = self.calls[self._entity_start:]
+		self.entity_seconds.append(sum(self.profile(call['model'])['seconds'] for call in calls if call['response'] is None))
+		self._entity_start = len(self.calls)
+
+	def report(self, concurrency):
+		# 所有出现过的文本去重后一次性批量编码
+		texts = {t for call in self.calls for t in call['inputs'] + [call['response']] if isinstance(t, str)}
+		texts = list(texts)
+		n_tokens = dict(zip(texts, count_tokens_batch(texts)))
+
+		def tokens(t):
+			return n_tokens[t] if isinstance(t, str) else t
+
+		per_model = defaultdict(lambda: {'calls': 0, 'cached_calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'seconds': 0.0, 'cost': 0.0})
+		for call in self.calls:
+			m = per_model[call['model']]
+			m['calls'] += 1
+			if call['response'] is not None:
+				m['cached_calls'] += 1
+				continue
+			profile = self.profile(call['model'])
+			# 失败的请求会重试，按失败率放大
+			retry_factor = 1 / (1 - min(profile['failure_rate'], 0.9))
+			input_tokens = sum(tokens(t) for t in call['inputs']) * retry_factor
+			output_tokens = profile['completion_tokens'] * retry_factor
+			price = self.pricing.get(call['model'], {})
+			m['input_tokens'] += input_tokens
+			m['output_tokens'] += output_tokens
+			m['seconds'] += profile['seconds'] * retry_factor
+			m['cost'] += (input_tokens * price.get('input', 0) + output_tokens * price.get('output', 0)) / 1e6
+
+		summary = {
+			'models': dict(per_model),
+			'total_cost': sum(m['cost'] for m in per_model.values()),
+			'wall_clock_seconds': sum(self.entity_seconds) / max(concurrency, 1),
+			'entities': len(self.entity_seconds),
+		}
+
+		print(f"\n=== Dry-run估计（{summary['entities']} 个实体，并发 {concurrency}）===")
+		for model, m in per_model.items():
+			source = f"{self.profile(model)['calls']} 次历史调用" if model in self.profiles else "无历史遥测，使用默认值"
+			print(f"  {model}: 调用 {m['calls']}（缓存命中 {m['cached_calls']}），输入 {m['input_tokens'] / 1e6:.2f}M tokens，"
+				f"输出约 {m['output_tokens'] / 1e6:.2f}M tokens，费用约 ${m['cost']:.2f}，吞吐依据: {source}")
+			if model not in self.pricing:
+				print(f"    ⚠️ config['pricing']中没有 {model} 的价格")
+		print(f"  总费用约 ${summary['total_cost']:.2f}，预计耗时约 {summary['wall_clock_seconds'] / 3600:.1f} 小时")
+		return summary
@@ -1,14 +1,23 @@
 import json
+import argparse
 import requests
 import time
 import os
 import pandas as pd
 import pdb
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from utils import get_response, save_result, save_result_txt, extract_json, ensure_question_format
 import random 
-from utils import set_cache_path
+from utils import set_cache_path, stable_string_hash, stable_string_hashes, config, telemetry_path
+from work_queue import WorkQueue
+from knowledge import KnowledgeStore, wiki_id_of
+from dedup import deduplicate
+from stage_policy import StagePolicy, KnowledgeSizePolicy, count_tokens, count_valid_questions
+from json_extract import QuestionStreamParser
+from estimate import RunEstimate, load_model_profiles
+from sampler import sample_entities, popularity_array, popularity_stats, print_popularity_stats
 
 # 配置方法选择
 search_model = 'gemini_search'  # 选择 'gemini_search' 或 'deer-flow'
@@ -18,12 +27,26 @@ entity_files = ['my_entities_en.csv']#, 'wikidata_entities_with_popularity_en_06
 output_file = 'bc_questions_0627_en_small.json'
 existing_files = []#"results/bc_questions_0625_en.json"]  # 已有的数据文件
 parallel = True
+dedup_threshold = None  # 派发前按label+description近似去重的相似度阈值（如0.8），None表示不去重；WIKI id不同的实体不会被合并
+popularity_mix = None  # 对entity_files中第二个文件按popularity区间分层采样（第一个文件全部保留），如 {'<0.001': 0.4, '0.001-0.01': 0.3, '0.01-0.1': 0.2, '0.1-1.0': 0.1}；None表示不分层
+legacy_ordering = True  # 采样顺序沿用stable_string_hash以复现已有划分；False改用BLAKE2b哈希（采样结果会变化）
+knowledge_db = None  # 按WIKI id保存搜索到的知识，如 'results/knowledge.db'；None表示不使用
+knowledge_reuse = None  # 其他语言已有同一WIKI id的知识时：'seed' 直接作为对话历史，'translate' 先翻译成当前语言，None 重新搜索
+translate_model = question_model
+question_ranges = [(4, 5), (5, 6)]  # 每组(N_I_LOW, N_I_HIGH)生成一次问题
+n_questions = 3  # 每次生成的问题数N_Q
+stream_questions = True  # 流式接收问题生成的输出，每个问题一闭合即校验，明显不合格时提前中止
+question_samples = 1  # 每轮并行请求的候选数，JSON格式经常不合格时可设为2~3，取第一个合格的
+stage_policy = StagePolicy()  # 每个实体都执行全部阶段；KnowledgeSizePolicy() 表示按知识量跳过/缩减阶段
 set_cache_path('.cache-bc_questions_0625_en.pkl') # '.cache-' + output_file.replace('.json', '.pkl'))
 
 progress_count = 0
 progress_lock = threading.Lock()
 total_entities = 0
 save_interval = 100  # 每100个实体保存一次
+max_workers = 15
+knowledge_store = None
+stage_log_lock = threading.Lock()
 
 def to_my_entity_key(entity_info):
 	if 'entity_info' in entity_info:
@@ -40,58 +63,202 @@ def save_progress(results, filename=None):
 	with open(f'results/{filename}', 'w', encoding='utf-8') as f:
 		json.dump(results, f, ensure_ascii=False, indent=2)
 
-def process_entity(entity_info):
-	"""处理单个实体的函数，用于并发执行"""
-	global progress_count, total_entities
-	
-	entity_name = entity_info['label']
-	entity_description = entity_info.get('description', '')
+def parse_shard(shard):
+	"""解析 'i/N' 格式的分片参数，i从0开始"""
+	if shard is None:
+		return None
+	i, n = (int(x) for x in shard.split('/'))
+	assert 0 <= i < n, f"非法分片: {shard}"
+	return i, n
+
+def in_shard(entity_key, shard):
+	"""按实体key的稳定hash分片，各机器无需协调即可得到相同划分"""
+	i, n = shard
+	return stable_string_hash(entity_key) % n == i
+
+def shard_mask(entity_keys, shard):
+	"""in_shard的批量版本，返回bool数组"""
+	i, n = shard
+	return stable_string_hashes(entity_keys) % n == i
+
+def shard_name(shard):
+	i, n = shard
+	return f"{output_file.rsplit('.json', 1)[0]}.shard{i}of{n}"
+
+def load_shard_results(path):
+	"""读取分片JSONL输出，返回 {entity_key: result}"""
+	results = {}
+	if not os.path.exists(path):
+		return results
+	with open(path, 'r', encoding='utf-8') as f:
+		for line in f:
+			try:
+				record = json.loads(line)
+			except json.JSONDecodeError:
+				continue  # 进程中断时可能留下不完整的最后一行
+			results[record['key']] = record['result']
+	return results
+
+def load_existing_results():
+	"""读取existing_files中的已有结果，统一转换为新格式key"""
+	existing_results = {}
 	
+	for existing_file in existing_files:
+		if os.path.exists(existing_file):
+			print(f"读取已有结果文件: {existing_file}")
+			with open(existing_file, 'r', encoding='utf-8') as f:
+				existing_data = json.load(f)
+				# 转换旧格式key为新格式
+				for key, value in existing_data.items():
+					if 'WIKI:' in key:
+						new_key = key
+					else:
+						new_key = to_my_entity_key(value)
+					existing_results[new_key] = value
+			print(f"已读取 {len(existing_data)} 个已有实体")
+		else:
+			print(f"⚠️ 文件不存在: {existing_file}")
+
+	return existing_results
+
+def reuse_knowledge(record, entity_name):
+	"""复用其他语言的两轮搜索结果，返回 (search_response, search_again_response)"""
+	if knowledge_reuse == 'seed':
+		return record['search_response'], record['search_again_response']
+
+	from prompts import get_prompt
+
+	translate_prompt = get_prompt('translate_knowledge_prompt', language).replace('{entity}', entity_name)
+	# 第二轮搜索被跳过时search_again_response为空串，无需翻译
+	return tuple(
+		get_response(model=translate_model, messages=[{'role': 'user', 'content': translate_prompt.replace('{knowledge}', text)}]) if text else text
+		for text in (record['search_response'], record['search_again_response'])
+	)
+
+def _start_entity(entity_name):
+	global progress_count
 	with progress_lock:
 		progress_count += 1
 		current = progress_count
-	
 	print(f"[{current}/{total_entities}] 开始查询实体: {entity_name}")
-	#import pdb; pdb.set_trace()
-	# 保存完整的实体信息
-	result = {
-		'entity': entity_name,
-		'entity_info': entity_info.to_dict() if hasattr(entity_info, 'to_dict') else entity_info
-	} 
-	
+
+def first_search_prompt(entity_info):
+	"""第一轮搜索的prompt - 使用label + description"""
+	from prompts import get_prompt
+
+	entity_name = entity_info['label']
+	entity_description = entity_info.get('description', '')
+	search_prompt = get_prompt('search_prompt', language)
+	entity_full = f"{entity_name}({entity_description})" if entity_description else entity_name
+	return search_prompt.replace('{entity}', entity_full, 1).replace('{entity}', entity_name)
+
+def collect_knowledge(entity_info, result):
+	"""两轮搜索（或复用其他语言的知识），结果写入result；返回对话历史，任一轮失败时返回None"""
 	from prompts import get_prompt
 
+	entity_name = entity_info['label']
 	messages = []
 
+	# 其他语言已搜索过同一WIKI id的实体时，复用其知识，跳过两轮搜索
+	wiki_id = wiki_id_of(entity_info)
+	reused = None
+	if knowledge_store is not None and knowledge_reuse and wiki_id is not None:
+		reused = knowledge_store.find_other_language(wiki_id, language)
+	if reused is not None:
+		reused_knowledge = reuse_knowledge(reused, entity_name)
+		if None in reused_knowledge:
+			reused = None  # 翻译失败时回退到搜索
+		else:
+			result['knowledge_source'] = {'wiki_id': wiki_id, 'language': reused['language'], 'mode': knowledge_reuse}
+
 	# 搜集实体信息 - 第一次使用label + description
-	search_prompt = get_prompt('search_prompt', language)
-	entity_full = f"{entity_name}({entity_description})" if entity_description else entity_name
-	prompt = search_prompt.replace('{entity}', entity_full, 1).replace('{entity}', entity_name)
+	prompt = first_search_prompt(entity_info)
 	messages.append({'role': 'user', 'content': prompt})
-	knowledge = get_response(model=search_model, messages=messages)
+	if reused is not None:
+		knowledge = reused_knowledge[0]
+	else:
+		knowledge = get_response(model=search_model, messages=messages)
 	result['search_response'] = knowledge
 	messages.append({'role': 'assistant', 'content': knowledge})
 
 	if knowledge is None:
-		return result
+		return None
 
-	# 二次扩展
-	search_second_prompt = get_prompt('search_second_prompt', language)
-	messages.append({'role': 'user', 'content': search_second_prompt})
-	knowledge2 = get_response(model=search_model, messages=messages)
+	# 二次扩展：第一轮知识已足够时由stage_policy决定跳过
+	# 复用的知识不涉及搜索调用，不做判断：原记录有第二轮知识时沿用，原记录跳过了第二轮时同样跳过（不发送空的assistant消息）
+	if reused is not None:
+		run_second, reason = (True, None) if reused_knowledge[1] else (False, f"reused {reused['language']} knowledge has no second search")
+	elif stage_policy.can_skip:
+		decisions = result.setdefault('stage_decisions', {})
+		decisions['search_tokens'] = count_tokens(knowledge)
+		run_second, reason = stage_policy.plan_second_search(decisions['search_tokens'])
+	else:
+		run_second, reason = True, None
+	if run_second:
+		search_second_prompt = get_prompt('search_second_prompt', language)
+		messages.append({'role': 'user', 'content': search_second_prompt})
+		if reused is not None:
+			knowledge2 = reused_knowledge[1]
+		else:
+			knowledge2 = get_response(model=search_model, messages=messages)
+		messages.append({'role': 'assistant', 'content': knowledge2})
+
+		if knowledge2 is None:
+			result['search_again_response'] = None
+			return None
+	else:
+		knowledge2 = ''
+		result.setdefault('stage_decisions', {})['skip_search_second'] = reason
 	result['search_again_response'] = knowledge2
-	messages.append({'role': 'assistant', 'content': knowledge2})
 
-	if knowledge2 is None:
-		return result
+	if knowledge_store is not None:
+		# 复用的知识同样按当前语言保存（source记录来源语言），questions-only模式才能包含这些实体
+		if reused is None:
+			knowledge_store.put(to_my_entity_key(entity_info), language, result['entity_info'], knowledge, knowledge2,
+				search_model=search_model, search_prompt=prompt)
+		else:
+			knowledge_store.put(to_my_entity_key(entity_info), language, result['entity_info'], knowledge, knowledge2,
+				search_model=reused['search_model'], search_prompt=prompt, source=f"{knowledge_reuse}:{reused['language']}")
+
+	return messages
+
+def knowledge_conversation(entity_info, knowledge, knowledge2):
+	"""用已保存的两轮知识重建与搜索时相同结构的对话历史"""
+	from prompts import get_prompt
+
+	messages = [
+		{'role': 'user', 'content': first_search_prompt(entity_info)},
+		{'role': 'assistant', 'content': knowledge},
+	]
+	# 第二轮搜索被跳过时search_again_response为空串
+	if knowledge2:
+		messages.extend([
+			{'role': 'user', 'content': get_prompt('search_second_prompt', language)},
+			{'role': 'assistant', 'content': knowledge2},
+		])
+	return messages
+
+def generate_questions(entity_name, messages, result):
+	"""基于对话历史中的知识，按question_ranges逐组生成问题，写入result['question_response']"""
+	from prompts import get_prompt
+
+	# 知识过少时由stage_policy缩减问题生成的组数；策略不会跳过任何阶段时不统计也不记录
+	ranges = question_ranges
+	if stage_policy.can_skip:
+		decisions = result.setdefault('stage_decisions', {})
+		decisions['knowledge_tokens'] = sum(count_tokens(m['content']) for m in messages if m['role'] == 'assistant')
+		ranges, reason = stage_policy.plan_question_ranges(decisions['knowledge_tokens'], question_ranges)
+		if reason is not None:
+			decisions['skip_question_ranges'] = {'ranges': [list(r) for r in question_ranges[len(ranges):]], 'reason': reason}
 
 	# 生成问题 - 后续只使用label
 	question_generate_prompt = get_prompt('question_generate_prompt', language)
-	for N_I_LOW, N_I_HIGH in [(4, 5), (5, 6)]:
-		prompt = question_generate_prompt.replace('{entity}', entity_name).replace('{N_I_LOW}', str(N_I_LOW)).replace('{N_I_HIGH}', str(N_I_HIGH)).replace('{N_Q}', '3')
+	for N_I_LOW, N_I_HIGH in ranges:
+		prompt = question_generate_prompt.replace('{entity}', entity_name).replace('{N_I_LOW}', str(N_I_LOW)).replace('{N_I_HIGH}', str(N_I_HIGH)).replace('{N_Q}', str(n_questions))
 
 		messages.append({'role': 'user', 'content': prompt})
-		response = get_response([extract_json, ensure_question_format], model=question_model, messages=messages)
+		response = get_response([extract_json, ensure_question_format], n_samples=question_samples,
+			stream_parser=QuestionStreamParser if stream_questions else None, model=question_model, messages=messages)
 
 		if 'question_response' not in result:
 			result['question_response'] = []
@@ -100,40 +267,94 @@ def process_entity(entity_info):
 		
 		messages.pop()
 
+	if stage_policy.can_skip:
+		decisions['valid_questions'] = [count_valid_questions(response) for response in result['question_response']]
+		log_stage_decisions(result)
+
 	# 	# 离线判定答案唯一性 TODO
 
+def stage_log_path():
+	return f"results/{output_file.rsplit('.json', 1)[0]}.stage_log.jsonl"
+
+def log_stage_decisions(result):
+	"""把每个实体的阶段决策及其问题有效数追加到stage_log，用于评估跳过策略对产出的影响"""
+	record = {'key': to_my_entity_key(result), 'policy': type(stage_policy).__name__, **result['stage_decisions']}
+	os.makedirs("results", exist_ok=True)
+	with stage_log_lock:
+		with open(stage_log_path(), 'a', encoding='utf-8') as f:
+			f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def summarize_stage_log():
+	"""按是否跳过阶段分组，统计实体数与平均有效问题数"""
+	if not os.path.exists(stage_log_path()):
+		return
+	groups = {}
+	with open(stage_log_path(), 'r', encoding='utf-8') as f:
+		for line in f:
+			record = json.loads(line)
+			group = ('跳过第二轮搜索' if 'skip_search_second' in record else '执行第二轮搜索',
+				'缩减问题组' if 'skip_question_ranges' in record else '全部问题组')
+			stats = groups.setdefault(group, [0, 0, 0])
+			stats[0] += 1
+			stats[1] += sum(record['valid_questions'])
+			stats[2] += len(record['valid_questions'])
+
+	print(f"📊 阶段决策统计 ({stage_log_path()}):")
+	for (second, ranges), (n_entities, n_valid, n_calls) in sorted(groups.items()):
+		print(f"  {second} / {ranges}: {n_entities} 个实体, 平均每次生成有效问题 {n_valid / max(n_calls, 1):.2f}, 平均每实体有效问题 {n_valid / n_entities:.2f}")
+
+def process_entity(entity_info):
+	"""处理单个实体的函数，用于并发执行"""
+	entity_name = entity_info['label']
+	_start_entity(entity_name)
+
+	#import pdb; pdb.set_trace()
+	# 保存完整的实体信息
+	result = {
+		'entity': entity_name,
+		'entity_info': entity_info.to_dict() if hasattr(entity_info, 'to_dict') else entity_info
+	} 
+
+	messages = collect_knowledge(result['entity_info'], result)
+	if messages is None:
+		return result
+
+	generate_questions(entity_name, messages, result)
+
 	return result
 
+def process_entity_from_knowledge(record):
+	"""questions-only模式：用知识库中保存的知识重建对话，只生成问题，不调用搜索"""
+	if record['entity_info']:
+		entity_info = json.loads(record['entity_info'])
+	else:
+		entity_info = {'label': record['entity'], 'id': record['wiki_id']}
+	entity_name = entity_info['label']
+	_start_entity(entity_name)
 
-def main():
-	global total_entities
-	
-	# 先读取已有结果文件
-	existing_results = {}
-	existing_entitiy_keys = set()
-	
-	for existing_file in existing_files:
-		if os.path.exists(existing_file):
-			print(f"读取已有结果文件: {existing_file}")
-			with open(existing_file, 'r', encoding='utf-8') as f:
-				existing_data = json.load(f)
-				# 转换旧格式key为新格式
-				for key, value in existing_data.items():
-					if 'WIKI:' in key:
-						new_key = key
-					else:
-						new_key = to_my_entity_key(value)
-					existing_results[new_key] = value
-			print(f"已读取 {len(existing_data)} 个已有实体")
-		else:
-			print(f"⚠️ 文件不存在: {existing_file}")
-	
-	existing_entitiy_keys = set(existing_results.keys())
-	print(f"总共已有 {len(existing_entitiy_keys)} 个实体")
-	
+	result = {
+		'entity': entity_name,
+		'entity_info': entity_info,
+		'search_response': record['search_response'],
+		'search_again_response': record['search_again_response'],
+		'knowledge_source': {'language': record['language'], 'source': record['source'], 'search_model': record['search_model'], 'updated_at': record['updated_at']},
+	}
+
+	messages = knowledge_conversation(entity_info, record['search_response'], record['search_again_response'])
+	generate_questions(entity_name, messages, result)
+
+	return result
+
+
+def load_entities(existing_entitiy_keys):
+	"""按优先级读取entity_files中的实体，排除已有实体并采样，展示popularity分布"""
 	# 读取多个实体文件
 	entities_data = []
+	dedup_clusters = []
 	n_entities = 10100
+	# 只有第二个文件按popularity_mix分层采样，第一个文件的实体全部保留
+	if popularity_mix and len(entity_files) < 2:
+		print(f"⚠️ popularity_mix只作用于entity_files中的第二个文件，当前只有 {len(entity_files)} 个文件，不会分层采样")
 	# 按优先级顺序读取各个文件
 	for i_f, entity_file in enumerate(entity_files):
 		df = pd.read_csv(entity_file)
@@ -153,54 +374,57 @@ def main():
 		_entities_data = [entity_dict for entity_dict in _entities_data if entity_dict['popularity_score'] < 10000]
 		print(f"按entity_info['popularity_score'] < 10000过滤后，剩余 {len(_entities_data)} 个新实体")
 
+		# 近似去重：每个重复簇只派发一个代表，与前面文件中已选实体重复的直接去掉
+		if dedup_threshold:
+			_entities_data, clusters = deduplicate(_entities_data, reference=entities_data, threshold=dedup_threshold)
+			dedup_clusters.extend(clusters)
+			print(f"近似去重后剩余 {len(_entities_data)} 个新实体（发现 {len(clusters)} 个重复簇）")
+
 		assert i_f < 2
 		if i_f == 1:
 			n_sample = n_entities - len(existing_entitiy_keys) - len(entities_data)
-			from utils import stable_shuffle
-			entities_data.extend(stable_shuffle(_entities_data)[:n_sample])
+			entities_data.extend(sample_entities(_entities_data, n_sample, mix=popularity_mix, legacy=legacy_ordering))
 		else:
 			entities_data.extend(_entities_data)
 	# 展示popularity分布
 	print(f"总共读取了 {len(entities_data)} 个实体")
+
+	if dedup_clusters:
+		cluster_file = f"{output_file.rsplit('.json', 1)[0]}.dedup_clusters.json"
+		save_progress(dedup_clusters, cluster_file)
+		print(f"重复簇详情: results/{cluster_file}")
 	
-	if 1:
-		# 提取popularity信息并展示分布
-		popularities = []
-		for entity in entities_data:
-			if 'popularity_score' in entity and entity['popularity_score'] is not None:
-				score = float(entity['popularity_score'])
-				import math 
-				if math.isnan(score): score = 0
-				
-				popularities.append(score)
-		
-		if popularities:
-			import numpy as np
-			print(f"\n=== Popularity分布统计 ===")
-			print(f"有效popularity记录数: {len(popularities)}")
-			print(f"最小值: {np.min(popularities):.4f}")
-			print(f"最大值: {np.max(popularities):.4f}")
-			print(f"平均值: {np.mean(popularities):.4f}")
-			print(f"中位数: {np.median(popularities):.4f}")
-			print(f"标准差: {np.std(popularities):.4f}")
-			
-			# 显示分位数
-			percentiles = [10, 25, 50, 75, 90, 95, 99]
-			print(f"\n分位数分布:")
-			for p in percentiles:
-				print(f"  {p}%: {np.percentile(popularities, p):.4f}")
-			
-			# 显示分布区间统计
-			bins = [0, 0.001, 0.01, 0.1, 1.0, float('inf')]
-			bin_labels = ['<0.001', '0.001-0.01', '0.01-0.1', '0.1-1.0', '>=1.0']
-			print(f"\n分布区间统计:")
-			for i in range(len(bins)-1):
-				count = sum(1 for p in popularities if bins[i] <= p < bins[i+1])
-				percentage = count / len(popularities) * 100
-				print(f"  {bin_labels[i]}: {count} ({percentage:.1f}%)")
-		else:
-			print("未找到有效的popularity数据")
+	# 提取popularity信息并展示分布
+	popularities = popularity_array(entities_data)
+	if len(popularities):
+		print_popularity_stats(popularity_stats(popularities))
+	else:
+		print("未找到有效的popularity数据")
+
+	return entities_data
+
+def main(shard=None):
+	global total_entities
+	
+	# 先读取已有结果文件
+	existing_results = load_existing_results()
+	existing_entitiy_keys = set(existing_results.keys())
+	print(f"总共已有 {len(existing_entitiy_keys)} 个实体")
 	
+	entities_data = load_entities(existing_entitiy_keys)
+
+	# 分片模式：只处理属于本分片、且尚未写入本分片输出的实体
+	shard_file = None
+	if shard is not None:
+		set_cache_path(f'.cache-{shard_name(shard)}.pkl')
+		shard_path = f'results/{shard_name(shard)}.jsonl'
+		shard_done = load_shard_results(shard_path)
+		mask = shard_mask([to_my_entity_key(entity_info) for entity_info in entities_data], shard)
+		entities_data = [entity_info for entity_info, keep in zip(entities_data, mask) if keep]
+		print(f"分片 {shard[0]}/{shard[1]}: 共 {len(entities_data)} 个实体，其中 {len(shard_done)} 个已完成")
+		entities_data = [entity_info for entity_info in entities_data if to_my_entity_key(entity_info) not in shard_done]
+		os.makedirs("results", exist_ok=True)
+		shard_file = open(shard_path, 'a', encoding='utf-8')
 	
 	total_entities = len(entities_data)
 
@@ -209,37 +433,44 @@ def main():
 	# 初始化结果字典，包含已有结果和新实体
 	results = existing_results.copy()  # 先复制已有结果
 
-	if parallel:
-		max_workers = 15
-		completed_count = 0
+	def collect(result, n_done):
+		key = to_my_entity_key(result)
+		results[key] = result
+		if shard_file is not None:
+			# 分片模式逐条追加，中断后可续跑
+			shard_file.write(json.dumps({'key': key, 'result': result}, ensure_ascii=False) + '\n')
+			shard_file.flush()
+		elif n_done % save_interval == 0:
+			# 每100个实体保存一次
+			print(f"💾 已完成 {n_done} 个实体，保存中间结果...")
+			save_progress(results)
+			print(f"💾 中间结果已保存: results/{output_file}")
+
+	try:
+		if parallel:
+			completed_count = 0
 		
-		with ThreadPoolExecutor(max_workers=max_workers) as executor:
-			# 提交所有任务
-			future_to_entity = {executor.submit(process_entity, entity_info): entity_info['label'] for entity_info in entities_data}
+			with ThreadPoolExecutor(max_workers=max_workers) as executor:
+				# 提交所有任务
+				future_to_entity = {executor.submit(process_entity, entity_info): entity_info['label'] for entity_info in entities_data}
 			
-			# 处理完成的任务
-			for future in as_completed(future_to_entity):
-				entity_name = future_to_entity[future]
-				result = future.result()
-				results[to_my_entity_key(result)] = result
-				completed_count += 1
-				
-				# 每100个实体保存一次
-				if completed_count % save_interval == 0:
-					print(f"💾 已完成 {completed_count} 个实体，保存中间结果...")
-					save_progress(results)
-					print(f"💾 中间结果已保存: results/{output_file}")
+				# 处理完成的任务
+				for future in as_completed(future_to_entity):
+					entity_name = future_to_entity[future]
+					completed_count += 1
+					collect(future.result(), completed_count)
 
-	else:
-		for i, entity_info in enumerate(entities_data, 1):
-			result = process_entity(entity_info)
-			results[to_my_entity_key(result)] = result
-			
-			# 每100个实体保存一次
-			if i % save_interval == 0:
-				print(f"💾 已完成 {i} 个实体，保存中间结果...")
-				save_progress(results)
-				print(f"💾 中间结果已保存: results/{output_file}")
+		else:
+			for i, entity_info in enumerate(entities_data, 1):
+				collect(process_entity(entity_info), i)
+	finally:
+		# 出错时同样关闭分片文件，已写入的行保留，可续跑
+		if shard_file is not None:
+			shard_file.close()
+
+	if shard_file is not None:
+		print(f"📁 分片结果保存在 {shard_file.name}，全部分片完成后使用 --merge {shard[1]} 合并")
+		return
 
 	# 统计结果：已有数据 + 新完成的数据
 	total_completed = len([result for result in results.values() if result is not None])
@@ -251,6 +482,7 @@ def main():
 	print(f"  新处理实体: {len(entities_data)}")
 	print(f"  新成功: {new_completed}, 新失败: {new_failed}")
 	print(f"  总计成功: {total_completed}, 总计实体: {len(results)}")
+	summarize_stage_log()
 
 	# 保存汇总结果
 	save_progress(results, output_file)
@@ -262,6 +494,218 @@ def main():
 	print(f"📄 JSON格式: results/{output_file}.json")
 	print(f"📄 TXT格式: results/{output_file}_simple.txt")
 
+def enqueue_entities(queue):
+	"""把本次要处理的实体写入任务队列，已在队列中的实体会被忽略"""
+	existing_entitiy_keys = set(load_existing_results().keys())
+	entities_data = load_entities(existing_entitiy_keys)
+	added = queue.enqueue((to_my_entity_key(entity_info), entity_info) for entity_info in entities_data)
+	print(f"📥 新加入队列 {added} 个实体，队列状态: {queue.counts()}")
+
+def run_queue_worker(queue):
+	"""
+	动态分配模式：从共享队列中租用实体并处理，空出一个线程就补领一个任务。
+	后台线程定期为处理中的实体续租；worker崩溃后其租约过期，任务会被其他worker重新领取。
+	"""
+	global total_entities
+
+	worker_id = f"{socket.gethostname()}-{os.getpid()}"
+	total_entities = sum(queue.counts().values())
+	print(f"👷 worker {worker_id} 启动，队列状态: {queue.counts()}")
+
+	held = set()
+	held_lock = threading.Lock()
+	stop = threading.Event()
+
+	def heartbeat():
+		while not stop.wait(queue.lease_seconds / 3):
+			with held_lock:
+				keys = list(held)
+			queue.heartbeat(worker_id, keys)
+
+	heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+	heartbeat_thread.start()
+
+	n_workers = max_workers if parallel else 1
+	future_to_key = {}
+	try:
+		with ThreadPoolExecutor(max_workers=n_workers) as executor:
+			while True:
+				for key, entity_info in queue.lease(worker_id, n_workers - len(future_to_key)):
+					with held_lock:
+						held.add(key)
+					future_to_key[executor.submit(process_entity, entity_info)] = key
+
+				if not future_to_key:
+					counts = queue.counts()
+					if counts.get('pending', 0) == 0 and counts.get('leased', 0) == 0:
+						break
+					# 剩余任务被其他worker持有，等待其完成或租约过期
+					time.sleep(min(30, queue.lease_seconds / 3))
+					continue
+
+				done, _ = wait(future_to_key, return_when=FIRST_COMPLETED)
+				for future in done:
+					key = future_to_key.pop(future)
+					try:
+						queue.complete(worker_id, key, future.result())
+					except Exception as e:
+						print(f"❌ 实体处理失败，释放任务: {key} ({e})")
+						queue.release(worker_id, key)
+					with held_lock:
+						held.discard(key)
+	finally:
+		stop.set()
+
+	print(f"👷 worker {worker_id} 结束，队列状态: {queue.counts()}")
+
+def export_queue_results(queue):
+	"""把队列中已完成的结果与已有结果合并，保存到results/{output_file}"""
+	results = load_existing_results()
+	for key, result in queue.results():
+		results[key] = result
+
+	print(f"📊 队列状态: {queue.counts()}，导出 {len(results)} 个实体")
+	save_progress(results, output_file)
+	save_result_txt(f'results/{output_file}_simple.txt', results)
+	print(f"📄 JSON格式: results/{output_file}")
+
+def plan_entity(entity_info, estimate):
+	"""dry-run：按与process_entity相同的流程构造每次调用的prompt；命中响应缓存的调用直接使用缓存中的回复"""
+	from prompts import get_prompt
+
+	entity_name = entity_info['label']
+
+	wiki_id = wiki_id_of(entity_info)
+	reused = None
+	if knowledge_store is not None and knowledge_reuse and wiki_id is not None:
+		reused = knowledge_store.find_other_language(wiki_id, language)
+
+	messages = [{'role': 'user', 'content': first_search_prompt(entity_info)}]
+	if reused is not None:
+		knowledge, knowledge2 = reused['search_response'], reused['search_again_response']
+		if knowledge_reuse == 'translate':
+			translate_prompt = get_prompt('translate_knowledge_prompt', language).replace('{entity}', entity_name)
+			knowledge, knowledge2 = (estimate.add_call(translate_model, [{'role': 'user', 'content': translate_prompt.replace('{knowledge}', text)}])
+				if text else text for text in (knowledge, knowledge2))
+	else:
+		knowledge = estimate.add_call(search_model, messages)
+	messages.append({'role': 'assistant', 'content': knowledge})
+
+	if reused is not None:
+		run_second = bool(knowledge2)  # 与collect_knowledge一致：原记录跳过了第二轮时同样跳过
+	elif stage_policy.can_skip:
+		run_second = stage_policy.plan_second_search(knowledge if isinstance(knowledge, int) else count_tokens(knowledge))[0]
+	else:
+		run_second = True
+	if run_second:
+		messages.append({'role': 'user', 'content': get_prompt('search_second_prompt', language)})
+		if reused is None:
+			knowledge2 = estimate.add_call(search_model, messages)
+		messages.append({'role': 'assistant', 'content': knowledge2})
+
+	ranges = question_ranges
+	if stage_policy.can_skip:
+		knowledge_tokens = sum(m['content'] if isinstance(m['content'], int) else count_tokens(m['content']) for m in messages if m['role'] == 'assistant')
+		ranges, _ = stage_policy.plan_question_ranges(knowledge_tokens, question_ranges)
+	question_generate_prompt = get_prompt('question_generate_prompt', language)
+	for N_I_LOW, N_I_HIGH in ranges:
+		prompt = question_generate_prompt.replace('{entity}', entity_name).replace('{N_I_LOW}', str(N_I_LOW)).replace('{N_I_HIGH}', str(N_I_HIGH)).replace('{N_Q}', str(n_questions))
+		estimate.add_call(question_model, messages + [{'role': 'user', 'content': prompt}])
+
+	estimate.end_entity()
+
+def dry_run():
+	"""估计本次运行的token量、费用与耗时，不调用任何模型"""
+	existing_entitiy_keys = set(load_existing_results().keys())
+	entities_data = load_entities(existing_entitiy_keys)
+
+	profiles = load_model_profiles(telemetry_path())
+	estimate = RunEstimate(profiles, config.get('pricing', {}))
+	for entity_info in entities_data:
+		plan_entity(entity_info, estimate)
+
+	return estimate.report(concurrency=max_workers if parallel else 1)
+
+def import_knowledge(files):
+	"""把已有results/*.json中的两轮搜索结果导入知识库（按当前language）"""
+	for path in files:
+		with open(path, 'r', encoding='utf-8') as f:
+			data = json.load(f)
+		n_imported = 0
+		for key, value in data.items():
+			if not value or value.get('search_response') is None or value.get('search_again_response') is None:
+				continue
+			entity_info = value['entity_info']
+			knowledge_store.put(to_my_entity_key(value), language, entity_info, value['search_response'], value['search_again_response'],
+				search_prompt=first_search_prompt(entity_info), source=f'import:{path}')
+			n_imported += 1
+		print(f"📥 从 {path} 导入 {n_imported} 个实体的知识")
+	print(f"📚 知识库中共有 {knowledge_store.count(language)} 个{language}实体")
+
+def regenerate_questions():
+	"""
+	questions-only模式：对知识库中当前language的全部实体重新生成问题，零搜索调用。
+	结果写入单独的results/{output_file去掉.json}.questions.json，知识库中没有的实体不在其中，不能覆盖主结果。
+	"""
+	global total_entities
+
+	records = list(knowledge_store.iter_language(language))
+	total_entities = len(records)
+	print(f"📚 知识库中共有 {total_entities} 个{language}实体，使用{question_model}重新生成问题")
+
+	questions_file = f"{output_file.rsplit('.json', 1)[0]}.questions.json"
+	results = {}
+	with ThreadPoolExecutor(max_workers=max_workers if parallel else 1) as executor:
+		futures = [executor.submit(process_entity_from_knowledge, record) for record in records]
+		for completed_count, future in enumerate(as_completed(futures), 1):
+			result = future.result()
+			results[to_my_entity_key(result)] = result
+			if completed_count % save_interval == 0:
+				print(f"💾 已完成 {completed_count} 个实体，保存中间结果...")
+				save_progress(results, questions_file)
+
+	save_progress(results, questions_file)
+	save_result_txt(f'results/{questions_file}_simple.txt', results)
+	print(f"📄 JSON格式: results/{questions_file}")
+
+def merge_shards(n_shards):
+	"""合并所有分片的JSONL输出到results/{output_file}，同一实体出现在多个分片且结果不一致时记录冲突"""
+	results = load_existing_results()
+	owner = {key: 'existing' for key in results}
+	conflicts = {}
+	misplaced = 0
+
+	for i in range(n_shards):
+		shard = (i, n_shards)
+		path = f'results/{shard_name(shard)}.jsonl'
+		if not os.path.exists(path):
+			print(f"⚠️ 分片文件不存在: {path}")
+			continue
+		shard_results = load_shard_results(path)
+		print(f"读取分片 {path}，共 {len(shard_results)} 个实体")
+
+		for key, result in shard_results.items():
+			if not in_shard(key, shard):
+				misplaced += 1
+			if key in owner:
+				if results[key] != result:
+					conflicts.setdefault(key, {owner[key]: results[key]})[i] = result
+				continue
+			owner[key] = i
+			results[key] = result
+
+	if misplaced:
+		print(f"⚠️ {misplaced} 个实体不属于其所在分片，请检查各分片是否使用了相同的N")
+	if conflicts:
+		conflict_file = f"{output_file.rsplit('.json', 1)[0]}.conflicts.json"
+		save_progress(conflicts, conflict_file)
+		print(f"⚠️ {len(conflicts)} 个实体在多个分片中结果不一致，保留最先出现的结果，冲突详情: results/{conflict_file}")
+
+	print(f"📊 合并后共 {len(results)} 个实体")
+	save_progress(results, output_file)
+	save_result_txt(f'results/{output_file}_simple.txt', results)
+	print(f"📄 JSON格式: results/{output_file}")
+
 def print_questions():
 	with open('results/claude-4-sonnet.json', 'r', encoding='utf-8') as f:
 		results = json.load(f)
@@ -276,5 +720,41 @@ def print_questions():
 		json.dump(simple_results, f, ensure_ascii=False, indent=4)
 
 if __name__ == "__main__":
-	main()
+	parser = argparse.ArgumentParser(description="生成实体问题")
+	parser.add_argument("--shard", default=None, help="分布式模式，格式 i/N：只处理第i个分片（从0开始），结果写入results/下的分片JSONL")
+	parser.add_argument("--merge", type=int, default=None, metavar="N", help="合并N个分片的输出到results/{output_file}")
+	parser.add_argument("--queue", default=None, help="动态分配模式：共享的SQLite任务队列文件，可同时启动任意多个worker进程")
+	parser.add_argument("--enqueue", action="store_true", help="与--queue配合：把实体写入队列后退出")
+	parser.add_argument("--export", action="store_true", help="与--queue配合：导出队列中已完成的结果到results/{output_file}")
+	parser.add_argument("--questions-only", action="store_true", help="只基于知识库中已保存的知识重新生成问题，不调用搜索；结果写入results/下的.questions.json，不覆盖output_file")
+	parser.add_argument("--import-knowledge", nargs="+", default=None, metavar="FILE", help="把已有结果文件中的搜索知识导入知识库后退出")
+	parser.add_argument("--dry-run", action="store_true", help="只估计token量、费用和耗时，不调用模型")
+	parser.add_argument("--lease-seconds", type=float, default=600, help="队列任务的租约时长，超时未续租的任务会被重新分配")
+	args = parser.parse_args()
+
+	if knowledge_db:
+		os.makedirs(os.path.dirname(knowledge_db) or '.', exist_ok=True)
+		knowledge_store = KnowledgeStore(knowledge_db)
+
+	if args.import_knowledge or args.questions_only:
+		assert knowledge_store is not None, "需要设置knowledge_db"
+
+	if args.dry_run:
+		dry_run()
+	elif args.import_knowledge:
+		import_knowledge(args.import_knowledge)
+	elif args.questions_only:
+		regenerate_questions()
+	elif args.merge is not None:
+		merge_shards(args.merge)
+	elif args.queue is not None:
+		queue = WorkQueue(args.queue, lease_seconds=args.lease_seconds)
+		if args.enqueue:
+			enqueue_entities(queue)
+		elif args.export:
+			export_queue_results(queue)
+		else:
+			run_queue_worker(queue)
+	else:
+		main(shard=parse_shard(args.shard))
 	#print_questions()
\ No newline at end of file
@@ -0,0 +1,227 @@
+import json
+import re
+
+_FENCED = re.compile(r'```(?:json)?[ \t]*\n(.*?)```', re.DOTALL)
+_SPECIAL = re.compile(r'[{}\[\]"\\]')
+_CLOSING = {'}': '{', ']': '['}
+
+def find_json_spans(text, pos=0):
+	"""
+	从pos开始单遍扫描text，返回 (spans, unclosed)：
+	spans为所有括号正确配对的 (start, end) 区间（包括嵌套的），
+	unclosed为扫描结束时仍未闭合的最外层括号位置（没有则为None）。
+	只在括号内部跟踪字符串，字符串中的括号和转义字符不参与配对；括号不匹配时丢弃当前栈。
+	"""
+	spans = []
+	stack = []
+	in_string = False
+	while True:
+		m = _SPECIAL.search(text, pos)
+		if m is None:
+			break
+		c = m.group()
+		pos = m.end()
+
+		if in_string:
+			if c == '\\':
+				pos += 1  # 跳过被转义的字符
+			elif c == '"':
+				in_string = False
+			continue
+
+		if c == '"':
+			in_string = bool(stack)
+		elif c in '{[':
+			stack.append((c, m.start()))
+		elif c in '}]':
+			if stack and stack[-1][0] == _CLOSING[c]:
+				_, start = stack.pop()
+				spans.append((start, pos))
+			else:
+				stack = []
+	return spans, (stack[0][1] if stack else None)
+
+def parse_longest_json(text, max_rescans=8):
+	"""
+	返回text中最长的可解析JSON对象或数组，找不到时返回None。
+	依次尝试：整段解析、```json代码块、单遍括号扫描得到的候选区间（从长到短）。
+	正文中的孤立括号或引号会让其后的内容无法闭合，此时从未闭合的括号之后重新扫描，最多max_rescans次。
+	"""
+	try:
+		return json.loads(text)
+	except json.JSONDecodeError:
+		pass
+
+	for block in sorted(_FENCED.findall(text), key=len, reverse=True):
+		try:
+			result = json.loads(block)
+		except json.JSONDecodeError:
+			continue
+		if isinstance(result, (dict, list)):
+			return result
+
+	pos = 0
+	for _ in range(max_rescans + 1):
+		spans, unclosed = find_json_spans(text, pos)
+		for start, end in sorted(spans, key=lambda span: span[0] - span[1]):
+			try:
+				return json.loads(text[start:end])
+			except json.JSONDecodeError:
+				continue
+		if unclosed is None:
+			break
+		pos = unclosed + 1
+	return None
+
+class QuestionStreamParser:
+	"""
+	增量解析问题生成的流式输出 {"entity": ..., "questions": [...]}。
+	"questions"数组中每个问题对象一闭合就立即解析并校验（与ensure_question_format一致，需为包含entity_type的对象），
+	发现明显不合格时设置malformed（原因），调用方可据此提前中止请求。JSON之前的说明文字会被跳过。
+	"""
+
+	def __init__(self):
+		self.buffer = ''
+		self.pos = 0
+		self.stack = []
+		self.in_string = False
+		self.string_start = None
+		self.last_key = None
+		self.last_key_end = None
+		self.root_pending = False
+		self.questions_array = False  # 是否出现过"questions"数组
+		self.questions_depth = None  # "questions"数组打开时的嵌套深度，数组闭合后为None
+		self.questions = []
+		self.malformed = None
+		self.done = False
+
+	def feed(self, chunk):
+		"""追加一段输出，返回本次新闭合并通过校验的问题对象列表"""
+		if self.done or self.malformed:
+			return []
+		self.buffer += chunk
+		n_before = len(self.questions)
+		text = self.buffer
+
+		while not (self.done or self.malformed):
+			m = _SPECIAL.search(text, self.pos)
+			if m is None:
+				break
+			c = m.group()
+			start = m.start()
+
+			if self.in_string:
+				if c == '\\':
+					if m.end() >= len(text):
+						break  # 被转义的字符还没到达
+					self.pos = m.end() + 1
+					continue
+				self.pos = m.end()
+				if c == '"':
+					self.in_string = False
+					if len(self.stack) == 1:
+						self.last_key = text[self.string_start + 1:start]
+						self.last_key_end = m.end()
+				continue
+
+			# 根对象的'{'之后必须紧跟键名，否则只是说明文字中的括号
+			if self.root_pending:
+				if c != '"' or text[self.stack[0][1] + 1:start].strip():
+					self.stack = []
+				self.root_pending = False
+
+			self.pos = m.end()
+			if c == '"':
+				if self.stack:
+					self.in_string = True
+					self.string_start = start
+			elif c in '{[':
+				if not self.stack:
+					if c == '{':
+						self.stack.append((c, start))
+						self.root_pending = True
+					continue
+				if (c == '[' and len(self.stack) == 1 and self.last_key == 'questions'
+						and text[self.last_key_end:start].strip() == ':'):
+					self.questions_array = True
+					self.questions_depth = len(self.stack) + 1
+				self.stack.append((c, start))
+			elif c in '}]':
+				if not self.stack:
+					continue
+				if self.stack[-1][0] != _CLOSING[c]:
+					self.malformed = f'unbalanced {c!r} at offset {start}'
+					break
+				if c == ']' and len(self.stack) == self.questions_depth:
+					# "questions"数组已闭合，之后同层的其他数组（如"notes"）不再按问题校验
+					self.questions_depth = None
+				_, open_at = self.stack.pop()
+				if c == '}' and len(self.stack) == self.questions_depth:
+					self._check_question(text[open_at:self.pos])
+				elif not self.stack:
+					self._close_root()
+
+		return self.questions[n_before:]
+
+	def _check_question(self, question_text):
+		try:
+			question = json.loads(question_text, strict=False)
+		except json.JSONDecodeError as e:
+			self.malformed = f'question {len(self.questions)} is not valid JSON: {e}'
+			return
+		if not isinstance(question, dict) or 'entity_type' not in question:
+			self.malformed = f'question {len(self.questions)} has no entity_type'
+			return
+		self.questions.append(question)
+
+	def _close_root(self):
+		self.done = True
+		if not self.questions_array:
+			self.malformed = 'no "questions" array in the JSON object'
+		elif not self.questions:
+			self.malformed = 'empty "questions" array'
+
+def _legacy_parse_json_safely(text):
+	"""原先逐字符raw_decode的实现，仅用于基准对比"""
+	try:
+		return json.loads(text)
+	except json.JSONDecodeError:
+		results = []
+		start = 0
+		while start < len(text):
+			try:
+				obj, end = json.JSONDecoder().raw_decode(text[start:])
+				results.append(obj)
+				start += end
+			except json.JSONDecodeError:
+				start += 1
+		if results:
+			return max(results, key=lambda x: len(json.dumps(x)))
+		return None
+
+if __name__ == '__main__':
+	# 基准：以响应缓存中的真实模型输出为语料，对比新旧实现的耗时与结果
+	import argparse
+	import pickle
+	import time
+
+	parser = argparse.ArgumentParser(description="extract_json基准测试")
+	parser.add_argument("cache_file", help="响应缓存文件（.pkl），其中的模型输出作为语料")
+	parser.add_argument("--limit", type=int, default=2000, help="最多使用的输出条数")
+	args = parser.parse_args()
+
+	with open(args.cache_file, 'rb') as f:
+		cache = pickle.load(f)
+	corpus = [v for k, v in cache.items() if k[0] == '_get_response' and isinstance(v, str) and '{' in v][:args.limit]
+	print(f"语料: {len(corpus)} 条输出，共 {sum(map(len, corpus)) / 1e6:.2f}M 字符")
+
+	timings = {}
+	outputs = {}
+	for name, func in [('legacy', _legacy_parse_json_safely), ('linear', parse_longest_json)]:
+		start = time.perf_counter()
+		outputs[name] = [func(text) for text in corpus]
+		timings[name] = time.perf_counter() - start
+		print(f"{name}: {timings[name]:.3f}s")
+
+	same = sum(a == b for a, b in zip(outputs['legacy'], outputs['linear']))
+	print(f"加速 {timings['legacy'] / max(timings['linear'], 1e-9):.1f}x，结果一致 {same}/{len(corpus)}")
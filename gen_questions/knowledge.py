@@ -0,0 +1,93 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+
+def wiki_id_of(entity_info):
+	"""实体的WIKI id；缺失或为nan时返回None（这类实体无法跨语言对应）"""
+	wiki_id = entity_info.get('id')
+	if wiki_id is None or (isinstance(wiki_id, float) and math.isnan(wiki_id)):
+		return None
+	wiki_id = str(wiki_id).strip()
+	if not wiki_id or wiki_id.lower() == 'nan':
+		return None
+	return wiki_id
+
+class KnowledgeStore:
+	"""
+	实体知识库：按 (entity_key, language) 保存两轮搜索得到的知识
+	(search_response/search_again_response)，并记录来源、搜索模型、搜索prompt和时间。
+
+	知识与问题生成解耦：可在其他语言的任务中按WIKI id复用，
+	也可在questions-only模式下用新的prompt或模型重新生成问题，而不再调用搜索。
+	source为 'search'、'import:<文件>'，或复用其他语言知识时的 'seed:<语言>'/'translate:<语言>'。
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._local = threading.local()
+
+		conn = self._conn()
+		conn.execute('PRAGMA journal_mode=WAL')
+		conn.execute('''CREATE TABLE IF NOT EXISTS entity_knowledge (
+			entity_key TEXT NOT NULL,
+			language TEXT NOT NULL,
+			wiki_id TEXT,
+			entity TEXT,
+			entity_info TEXT,
+			search_model TEXT,
+			search_prompt TEXT,
+			search_response TEXT NOT NULL,
+			search_again_response TEXT NOT NULL,
+			source TEXT,
+			created_at REAL,
+			updated_at REAL,
+			PRIMARY KEY (entity_key, language)
+		)''')
+		conn.execute('CREATE INDEX IF NOT EXISTS idx_entity_knowledge_wiki ON entity_knowledge (wiki_id, language)')
+
+	def _conn(self):
+		# sqlite3连接不能跨线程使用，每个线程各自持有一个
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+			conn.row_factory = sqlite3.Row
+			self._local.conn = conn
+		return conn
+
+	def put(self, entity_key, language, entity_info, search_response, search_again_response,
+			search_model=None, search_prompt=None, source='search'):
+		"""写入一条知识；已存在时更新内容和updated_at，保留created_at"""
+		now = time.time()
+		self._conn().execute('''INSERT INTO entity_knowledge
+			(entity_key, language, wiki_id, entity, entity_info, search_model, search_prompt,
+			 search_response, search_again_response, source, created_at, updated_at)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			ON CONFLICT (entity_key, language) DO UPDATE SET
+				wiki_id = excluded.wiki_id, entity = excluded.entity, entity_info = excluded.entity_info,
+				search_model = excluded.search_model, search_prompt = excluded.search_prompt,
+				search_response = excluded.search_response, search_again_response = excluded.search_again_response,
+				source = excluded.source, updated_at = excluded.updated_at''',
+			(entity_key, language, wiki_id_of(entity_info), entity_info.get('label'), json.dumps(entity_info, ensure_ascii=False),
+			 search_model, search_prompt, search_response, search_again_response, source, now, now))
+
+	def get(self, entity_key, language):
+		row = self._conn().execute('SELECT * FROM entity_knowledge WHERE entity_key = ? AND language = ?', (entity_key, language)).fetchone()
+		return dict(row) if row else None
+
+	def find_other_language(self, wiki_id, language):
+		"""同一WIKI id在其他语言下的知识，优先取搜索或导入得到的原始知识，没有则返回None"""
+		row = self._conn().execute('''SELECT * FROM entity_knowledge WHERE wiki_id = ? AND language != ?
+			ORDER BY (source LIKE 'seed:%' OR source LIKE 'translate:%'), updated_at DESC LIMIT 1''', (wiki_id, language)).fetchone()
+		return dict(row) if row else None
+
+	def iter_language(self, language):
+		"""按写入顺序遍历某种语言的全部知识"""
+		for row in self._conn().execute('SELECT * FROM entity_knowledge WHERE language = ? ORDER BY rowid', (language,)):
+			yield dict(row)
+
+	def count(self, language=None):
+		if language is None:
+			return self._conn().execute('SELECT COUNT(*) FROM entity_knowledge').fetchone()[0]
+		return self._conn().execute('SELECT COUNT(*) FROM entity_knowledge WHERE language = ?', (language,)).fetchone()[0]
@@ -5,6 +5,10 @@ PROMPTS = {
         
         'search_second_prompt': """请继续搜索，对你已经搜集到的知识进行验证和扩充，比如搜索密切相关的人物、事件、物品等实体。""",
         
+        'translate_knowledge_prompt': """请把以下关于'{entity}'的资料完整地翻译成中文，保留markdown格式和所有事实细节，不要删减、总结或添加任何信息。只输出翻译结果。
+
+{knowledge}""",
+        
         'question_generate_prompt': """请根据{entity}的相关知识，组合{N_I_LOW}到{N_I_HIGH}条信息，设计{N_Q}道以{entity}为答案的中文问题。
 
 这些题目应该满足：
@@ -58,6 +62,10 @@ PROMPTS = {
         
         'search_second_prompt': """Please continue searching to verify and expand on the knowledge you have already collected, such as searching for closely related people, events, objects, and other entities.""",
         
+        'translate_knowledge_prompt': """Please translate the following document about '{entity}' into English in full. Keep the markdown format and every factual detail; do not omit, summarize or add any information. Output only the translation.
+
+{knowledge}""",
+        
         'question_generate_prompt': """Based on the relevant knowledge about {entity}, combine {N_I_LOW} to {N_I_HIGH} pieces of information to design {N_Q} English questions with {entity} as the answer.
 
 These questions should satisfy:
@@ -113,7 +121,7 @@ def get_prompt(prompt_name, language='zh'):
     Get a prompt in the specified language.
     
     Args:
-        prompt_name (str): Name of the prompt ('search_prompt', 'search_second_prompt', 'question_generate_prompt')
+        prompt_name (str): Name of the prompt ('search_prompt', 'search_second_prompt', 'question_generate_prompt', 'translate_knowledge_prompt')
         language (str): Language code ('zh' for Chinese, 'en' for English)
     
     Returns:
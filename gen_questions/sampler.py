@@ -0,0 +1,112 @@
+import math
+import numpy as np
+from utils import stable_string_hashes, smallest_k
+
+# popularity区间：[bins[i], bins[i+1])
+POPULARITY_BINS = [0, 0.001, 0.01, 0.1, 1.0, float('inf')]
+POPULARITY_BIN_LABELS = ['<0.001', '0.001-0.01', '0.01-0.1', '0.1-1.0', '>=1.0']
+PERCENTILES = [10, 25, 50, 75, 90, 95, 99]
+
+def _to_score(value):
+	if value is None:
+		return None
+	score = float(value)
+	return 0.0 if math.isnan(score) else score
+
+def popularity_array(entities):
+	"""提取有效的popularity_score（NaN记为0，None跳过）"""
+	scores = (_to_score(entity.get('popularity_score')) for entity in entities)
+	return np.fromiter((s for s in scores if s is not None), dtype=np.float64)
+
+def bin_index(popularities, bins=POPULARITY_BINS):
+	"""每个值所在区间的下标，不落在任何区间内的记为-1"""
+	idx = np.searchsorted(bins, popularities, side='right') - 1
+	idx[(idx < 0) | (idx >= len(bins) - 1)] = -1
+	return idx
+
+def popularity_stats(popularities, bins=POPULARITY_BINS, bin_labels=POPULARITY_BIN_LABELS, percentiles=PERCENTILES):
+	"""一次性计算popularity的统计量、分位数与区间分布"""
+	popularities = np.asarray(popularities, dtype=np.float64)
+	idx = bin_index(popularities, bins)
+	counts = np.bincount(idx[idx >= 0], minlength=len(bins) - 1)
+	return {
+		'count': int(len(popularities)),
+		'min': float(popularities.min()),
+		'max': float(popularities.max()),
+		'mean': float(popularities.mean()),
+		'median': float(np.median(popularities)),
+		'std': float(popularities.std()),
+		'percentiles': dict(zip(percentiles, np.percentile(popularities, percentiles).tolist())),
+		'bins': dict(zip(bin_labels, counts.tolist())),
+	}
+
+def print_popularity_stats(stats):
+	print(f"\n=== Popularity分布统计 ===")
+	print(f"有效popularity记录数: {stats['count']}")
+	print(f"最小值: {stats['min']:.4f}")
+	print(f"最大值: {stats['max']:.4f}")
+	print(f"平均值: {stats['mean']:.4f}")
+	print(f"中位数: {stats['median']:.4f}")
+	print(f"标准差: {stats['std']:.4f}")
+
+	print(f"\n分位数分布:")
+	for p, value in stats['percentiles'].items():
+		print(f"  {p}%: {value:.4f}")
+
+	print(f"\n分布区间统计:")
+	for label, count in stats['bins'].items():
+		percentage = count / stats['count'] * 100
+		print(f"  {label}: {count} ({percentage:.1f}%)")
+
+def entity_hashes(entities, legacy=True):
+	"""与stable_shuffle相同的排序键：label + popularity_score"""
+	return stable_string_hashes([entity['label'] + str(entity['popularity_score']) for entity in entities], legacy=legacy)
+
+def _allocate(n, mix):
+	"""按比例把n分配到各区间，余数按小数部分从大到小分配"""
+	total = sum(mix.values())
+	raw = {label: n * weight / total for label, weight in mix.items()}
+	quotas = {label: int(value) for label, value in raw.items()}
+	remainder = n - sum(quotas.values())
+	for label in sorted(raw, key=lambda l: raw[l] - quotas[l], reverse=True)[:remainder]:
+		quotas[label] += 1
+	return quotas
+
+def sample_entities(entities, n, mix=None, bins=POPULARITY_BINS, bin_labels=POPULARITY_BIN_LABELS, legacy=True):
+	"""
+	确定性地采样n个实体。
+
+	mix为None时结果等价于 stable_shuffle(entities)[:n]。
+	mix为 {区间标签: 权重} 时，在每个popularity区间内按hash取前k个；
+	某个区间实体不足时，缺口由其余实体按hash顺序补齐。
+	legacy=False时改用BLAKE2b哈希排序，结果与以往的划分不同。
+	"""
+	if n <= 0 or not entities:
+		return []
+
+	hashes = entity_hashes(entities, legacy=legacy)
+
+	if mix is None:
+		return [entities[i] for i in smallest_k(hashes, n)]
+
+	unknown = set(mix) - set(bin_labels)
+	assert not unknown, f'未知的popularity区间: {unknown}'
+
+	scores = np.fromiter((_to_score(entity.get('popularity_score')) or 0.0 for entity in entities),
+		dtype=np.float64, count=len(entities))
+	idx = bin_index(scores, bins)
+
+	selected = []
+	for label, quota in _allocate(n, mix).items():
+		members = np.flatnonzero(idx == bin_labels.index(label))
+		selected.append(members[smallest_k(hashes[members], quota)])
+	selected = np.concatenate(selected)
+
+	shortfall = n - len(selected)
+	if shortfall > 0:
+		rest = np.setdiff1d(np.arange(len(entities)), selected)
+		selected = np.concatenate([selected, rest[smallest_k(hashes[rest], shortfall)]])
+
+	# 输出顺序与stable_shuffle一致
+	selected = selected[np.lexsort((selected, hashes[selected]))]
+	return [entities[i] for i in selected]
@@ -0,0 +1,45 @@
+from utils import count_tokens
+
+def count_valid_questions(question_response):
+	"""一次问题生成中可用的问题数（至少2个entity_type且包含{entity_type}占位符）"""
+	if not question_response:
+		return 0
+	return sum(1 for q in question_response.get('questions', [])
+		if isinstance(q, dict) and len(q.get('entity_type', [])) >= 2 and '{entity_type}' in q.get('question', ''))
+
+class StagePolicy:
+	"""阶段策略基类：每个实体都执行全部阶段，与原流程一致"""
+
+	# 为False时调用方不统计知识的token数、不记录stage_decisions和stage_log
+	can_skip = False
+
+	def plan_second_search(self, knowledge_tokens):
+		"""返回 (是否执行第二轮搜索, 原因)"""
+		return True, None
+
+	def plan_question_ranges(self, knowledge_tokens, question_ranges):
+		"""返回 (本实体使用的question_ranges, 原因)"""
+		return question_ranges, None
+
+class KnowledgeSizePolicy(StagePolicy):
+	"""
+	按知识量决定阶段：
+	- 第一轮搜索结果已足够长时，跳过第二轮搜索；
+	- 两轮搜索的总知识过少时，只生成第一组问题（信息不足以组合更多条件）。
+	"""
+
+	can_skip = True
+
+	def __init__(self, skip_second_search_tokens=4000, full_ranges_min_tokens=1500):
+		self.skip_second_search_tokens = skip_second_search_tokens
+		self.full_ranges_min_tokens = full_ranges_min_tokens
+
+	def plan_second_search(self, knowledge_tokens):
+		if knowledge_tokens >= self.skip_second_search_tokens:
+			return False, f"first search has {knowledge_tokens} tokens >= {self.skip_second_search_tokens}"
+		return True, None
+
+	def plan_question_ranges(self, knowledge_tokens, question_ranges):
+		if knowledge_tokens < self.full_ranges_min_tokens and len(question_ranges) > 1:
+			return question_ranges[:1], f"knowledge has {knowledge_tokens} tokens < {self.full_ranges_min_tokens}"
+		return question_ranges, None
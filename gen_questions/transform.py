@@ -25,7 +25,8 @@ for lang in ['en', 'zh']:
     data_ = {}
     for k, v in data.items():
         try:
-            assert(v['search_response'] is not None and v['search_again_response'] is not None and v['question_response'] is not None and len(v['question_response']) == 2)
+            # stage_policy缩减问题组时只有一组question_response
+            assert(v['search_response'] is not None and v['search_again_response'] is not None and v['question_response'] is not None and (len(v['question_response']) == 2 or 'skip_question_ranges' in v.get('stage_decisions', {})))
             for qr in v['question_response']:
                 for qs in qr['questions']:
                     assert(len(qs['entity_type']) >= 2)
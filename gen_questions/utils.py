@@ -1,49 +1,196 @@
-import pdb 
 import os
+import sys
 import re 
 import random 
-import openai
 import json
 import logging
+import logging.handlers
+import queue
+import copy
+import atexit
 import time  
-import jsonlines 
-import requests 
 import io
 import pickle
 import random
 import __main__
-import tiktoken
 import threading
+import hashlib
+from collections import OrderedDict
 from typing import Dict, List
+from json_extract import parse_longest_json
 
-with open('config.json', 'r') as f:
-	config = json.load(f)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import token_budget
+
+# config、编码器、日志和openai/requests/tiktoken都在首次使用时才初始化，
+# 只用到部分工具函数的离线脚本import utils时不再读取配置、下载BPE或创建日志文件
+_config = None
+_config_lock = threading.Lock()
+
+def get_config():
+	"""首次调用时读取config.json"""
+	global _config
+	if _config is None:
+		with _config_lock:
+			if _config is None:
+				with open('config.json', 'r') as f:
+					_config = json.load(f)
+	return _config
+
+def __getattr__(name):
+	# 兼容 from utils import config / utils.enc 等旧用法
+	if name == 'config':
+		return get_config()
+	if name == 'enc':
+		return get_encoding()
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 streaming = False
 
-def setup_logger(name, log_file, level=logging.INFO, quiet=False):
+def logging_config():
+	"""
+	config['logging']中的日志设置：
+	max_message_chars为单条消息的最大字符数（超出部分截断，记录原长度），null表示不截断；
+	response_dump_rate为完整记录模型回复的采样比例，其余只记录截断后的预览。
+	"""
+	return get_config().get('logging', {})
+
+def truncate_message(message, max_chars):
+	if max_chars is None or len(message) <= max_chars:
+		return message
+	return f'{message[:max_chars]}...[truncated {len(message) - max_chars} chars]'
+
+class TruncatingFormatter(logging.Formatter):
+	"""超长消息截断；带extra={'full_payload': True}的记录不截断"""
+
+	def __init__(self, fmt=None, max_chars=None):
+		super().__init__(fmt)
+		self.max_chars = max_chars
+
+	def formatMessage(self, record):
+		if not getattr(record, 'full_payload', False):
+			record.message = truncate_message(record.message, self.max_chars)
+		return super().formatMessage(record)
+
+class JsonFormatter(logging.Formatter):
+	"""每条日志一行JSON，便于按字段检索"""
+
+	def __init__(self, max_chars=None):
+		super().__init__()
+		self.max_chars = max_chars
+
+	def format(self, record):
+		message = record.getMessage()
+		entry = {
+			'time': self.formatTime(record),
+			'logger': record.name,
+			'level': record.levelname,
+			'thread': record.threadName,
+			'location': f'{record.filename}:{record.lineno}',
+		}
+		if not getattr(record, 'full_payload', False) and self.max_chars is not None and len(message) > self.max_chars:
+			entry['message'] = message[:self.max_chars]
+			entry['truncated_chars'] = len(message) - self.max_chars
+		else:
+			entry['message'] = message
+		if record.exc_info and not record.exc_text:
+			record.exc_text = self.formatException(record.exc_info)
+		if record.exc_text:
+			entry['exc_info'] = record.exc_text
+		return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _PassthroughQueueHandler(logging.handlers.QueueHandler):
+	"""
+	只在调用线程中拼好消息（getMessage），格式化和I/O都交给QueueListener的后台线程，
+	从而保留extra字段供后台的formatter使用。
+	"""
+
+	def prepare(self, record):
+		record = copy.copy(record)
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info and not record.exc_text:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+		record.exc_info = None
+		return record
+
+_log_listeners = {}
+
+def setup_logger(name, log_file, level=logging.INFO, quiet=False, structured=None, max_chars=None):
+	"""
+	日志通过队列异步写出：调用线程只把记录放入队列，文件和控制台输出在后台线程完成，
+	多线程调用时不再因文件I/O和handler锁互相阻塞。
+	structured为True时文件中每行一条JSON记录；structured和max_chars未指定时取config['logging']中的设置。
+	"""
+	if structured is None:
+		structured = logging_config().get('structured', False)
+	if max_chars is None:
+		max_chars = logging_config().get('max_message_chars', 4000)
+
 	logger = logging.getLogger(name)
 	logger.setLevel(level)
 
 	if logger.hasHandlers():
 		logger.handlers.clear()
+	if name in _log_listeners:
+		_log_listeners.pop(name).stop()
 
 	file_handler = logging.FileHandler(log_file, encoding='utf-8')
 	file_handler.setLevel(logging.DEBUG)
-	file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-	file_handler.setFormatter(file_formatter)
-	logger.addHandler(file_handler)
+	if structured:
+		file_handler.setFormatter(JsonFormatter(max_chars))
+	else:
+		file_handler.setFormatter(TruncatingFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', max_chars))
+	handlers = [file_handler]
 
 	if not quiet:
 		console_handler = logging.StreamHandler()
 		console_handler.setLevel(level)
-		console_formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s [%(filename)s:%(lineno)d]')
-		console_handler.setFormatter(console_formatter)
-		logger.addHandler(console_handler)
+		console_handler.setFormatter(TruncatingFormatter('%(name)s - %(levelname)s - %(message)s [%(filename)s:%(lineno)d]', max_chars))
+		handlers.append(console_handler)
+
+	log_queue = queue.SimpleQueue()
+	logger.addHandler(_PassthroughQueueHandler(log_queue))
+	listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+	listener.start()
+	_log_listeners[name] = listener
 
 	return logger
 
-logger = setup_logger(__name__, f'{__file__.split(".")[0]}.log', level=logging.INFO, quiet=False)
+@atexit.register
+def _stop_log_listeners():
+	"""退出前把队列中剩余的日志写完"""
+	for listener in _log_listeners.values():
+		listener.stop()
+	_log_listeners.clear()
+
+class _LazySetupHandler(logging.Handler):
+	"""占位handler：第一条日志到达时才调用setup_logger（创建日志文件），再把这条日志交给新的handler"""
+
+	def __init__(self, setup):
+		super().__init__()
+		self.setup = setup
+		self.setup_lock = threading.Lock()
+
+	def handle(self, record):
+		with self.setup_lock:
+			logger = self.setup()
+		for handler in logger.handlers:
+			if handler is not self and record.levelno >= handler.level:
+				handler.handle(record)
+		return True
+
+	def emit(self, record):
+		pass
+
+def _setup_module_logger():
+	if any(isinstance(handler, _LazySetupHandler) for handler in logger.handlers):
+		setup_logger(__name__, f'{__file__.split(".")[0]}.log', level=logging.INFO, quiet=False)
+	return logger
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(_LazySetupHandler(_setup_module_logger))
 
 from contextlib import contextmanager
 import tempfile
@@ -119,7 +266,7 @@ def safe_pickle_dump(obj, fname):
 
 ERROR_SIGN = '[ERROR]'
 
-cache_path = config['cache']['default_path']
+cache_path = None  # None表示使用config['cache']['default_path']
 cache_sign = True
 cache = None
 reload_cache = False
@@ -132,33 +279,58 @@ def set_cache_path(new_cache_path):
 	reload_cache = True
 	print(f"set cache path to {cache_path}")
 
-def cached(func):
-	def wrapper(*args, **kwargs):		
-		# extract_from_chunk 
-		if func.__name__ == 'extract_from_chunk':
-			key = ( func.__name__, args[0]['title'], args[1]) 
+def get_cache_path():
+	return cache_path or get_config()['cache']['default_path']
+
+# 只影响请求方式、不影响结果的参数，不计入缓存key
+UNCACHED_KWARGS = {'stream_parser'}
+
+def _cache_key(func_name, args, kwargs):
+	# extract_from_chunk 
+	if func_name == 'extract_from_chunk':
+		return ( func_name, args[0]['title'], args[1]) 
+	else:
+		if UNCACHED_KWARGS & kwargs.keys():
+			kwargs = {k: v for k, v in kwargs.items() if k not in UNCACHED_KWARGS}
+		return ( func_name, str(args), str(kwargs.items())) 
+
+def _load_cache():
+	"""加载缓存（调用方需持有cache_lock）"""
+	global cache
+	global reload_cache
+
+	if reload_cache:
+		cache = None # to reload
+		reload_cache = False
+
+	if cache == None:
+		if not os.path.exists(get_cache_path()):
+			cache = {}
 		else:
-			key = ( func.__name__, str(args), str(kwargs.items())) 
+			try:
+				cache = pickle.load(open(get_cache_path(), 'rb'))  
+			except Exception as e:
+				# logger.info cache_path and throw error
+				logger.error(f'Error loading cache from {get_cache_path()}')
+				cache = {}
 
-		global cache
-		global reload_cache
+def cache_get(func_name, *args, **kwargs):
+	"""查询被@cached修饰的函数以相同参数调用时的缓存结果，未命中时返回None（不会调用该函数）"""
+	key = _cache_key(func_name, args, kwargs)
+	with cache_lock:
+		_load_cache()
+		value = cache.get(key)
+	if value is None or value == ERROR_SIGN:
+		return None
+	return value
+
+def cached(func):
+	def wrapper(*args, **kwargs):		
+		key = _cache_key(func.__name__, args, kwargs)
 
 		# 使用线程锁保护缓存操作
 		with cache_lock:
-			if reload_cache:
-				cache = None # to reload
-				reload_cache = False
-
-			if cache == None:
-				if not os.path.exists(cache_path):
-					cache = {}
-				else:
-					try:
-						cache = pickle.load(open(cache_path, 'rb'))  
-					except Exception as e:
-						# logger.info cache_path and throw error
-						logger.error(f'Error loading cache from {cache_path}')
-						cache = {}
+			_load_cache()
 
 			if (cache_sign and key in cache) and not (cache[key] is None) and (not cache[key] == ERROR_SIGN):
 				return cache[key]
@@ -173,30 +345,82 @@ def cached(func):
 				# 创建缓存副本避免在保存时被修改
 				cache_copy = cache.copy()
 			# 在锁外保存文件
-			safe_pickle_dump(cache_copy, cache_path)
+			safe_pickle_dump(cache_copy, get_cache_path())
 		
 		return result
 
 	return wrapper
 
-enc = tiktoken.get_encoding(config['encoding']['name'])
+def get_encoding(encoding_name=None):
+	"""按名称缓存tiktoken编码（默认config['encoding']['name']），与token_budget共用同一缓存"""
+	return token_budget.get_encoding(encoding_name or get_config()['encoding']['name'])
 
 def encode(text):
-	return enc.encode(text)
+	return get_encoding().encode(text)
+
+def encode_batch(texts, num_threads=8):
+	"""多线程批量编码，特殊token按普通文本处理"""
+	return get_encoding().encode_ordinary_batch(texts, num_threads=num_threads)
 
 def decode(tokens):
-	return enc.decode(tokens)
+	return get_encoding().decode(tokens)
+
+# token数的LRU缓存，key为 (编码名, 文本内容的哈希)，不保存原文
+token_count_cache_size = None  # None表示使用config['encoding']['count_cache_size']（默认200000）
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+def _content_key(encoding_name, text):
+	return encoding_name, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+def count_tokens_batch(texts, encoding_name=None, num_threads=8):
+	"""
+	批量计算token数（特殊token按普通文本处理），返回与texts等长的列表。
+	先查LRU缓存，未命中的文本去重后一次性多线程编码。
+	"""
+	encoding_name = encoding_name or get_config()['encoding']['name']
+	keys = [_content_key(encoding_name, text) for text in texts]
+	counts = [None] * len(texts)
+	missing = {}
+	with _token_counts_lock:
+		for i, key in enumerate(keys):
+			n = _token_counts.get(key)
+			if n is None:
+				missing.setdefault(key, []).append(i)
+			else:
+				_token_counts.move_to_end(key)
+				counts[i] = n
+	if not missing:
+		return counts
+
+	missing_keys = list(missing)
+	encoded = get_encoding(encoding_name).encode_ordinary_batch([texts[missing[key][0]] for key in missing_keys], num_threads=num_threads)
+	with _token_counts_lock:
+		for key, tokens in zip(missing_keys, encoded):
+			for i in missing[key]:
+				counts[i] = len(tokens)
+			_token_counts[key] = len(tokens)
+		max_size = token_count_cache_size or get_config()['encoding'].get('count_cache_size', 200000)
+		while len(_token_counts) > max_size:
+			_token_counts.popitem(last=False)
+	return counts
+
+def count_tokens(text, encoding_name=None):
+	"""单条文本的token数，空文本或非字符串为0"""
+	if not text or not isinstance(text, str):
+		return 0
+	return count_tokens_batch([text], encoding_name, num_threads=1)[0]
 
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
-	encoding = tiktoken.get_encoding(encoding_name)
-	num_tokens = len(encoding.encode(string))
-	logger.info(f"Number of tokens: {num_tokens}")
+	num_tokens = count_tokens(string, encoding_name)
+	logger.debug(f"Number of tokens: {num_tokens}")
 	return num_tokens
 
 def gemini(messages, search=False):
 	"""使用现有的gemini search API"""
 	# 从配置文件获取API配置
-	gemini_config = config['gemini_search']
+	import requests
+	gemini_config = get_config()['gemini_search']
 	url = gemini_config['url']
 	params = {
 		"ak": gemini_config['ak']
@@ -255,10 +479,29 @@ def gemini(messages, search=False):
 		time.sleep(30)
 		return None
 
-def claude(messages):
+def _stream_chat(client, stream_parser, **create_kwargs):
+	"""流式请求，边接收边交给stream_parser校验；判定为明显不合格时提前中止并返回ERROR_SIGN"""
+	parser = stream_parser()
+	stream = client.chat.completions.create(stream=True, **create_kwargs)
+	content = []
+	try:
+		for chunk in stream:
+			if not chunk.choices or not chunk.choices[0].delta.content:
+				continue
+			content.append(chunk.choices[0].delta.content)
+			parser.feed(chunk.choices[0].delta.content)
+			if parser.malformed:
+				logger.warning(f'Aborting generation after {sum(map(len, content))} chars: {parser.malformed}')
+				return ERROR_SIGN
+	finally:
+		stream.close()
+	return ''.join(content)
+
+def claude(messages, stream_parser=None):
 	"""使用现有的claude API"""
 	# 从配置文件获取API配置
-	claude_config = config['claude']
+	import openai
+	claude_config = get_config()['claude']
 	
 	# 请求数据
 	client = openai.AzureOpenAI(
@@ -268,7 +511,7 @@ def claude(messages):
 	)
 
 	try:
-		response = client.chat.completions.create(
+		create_kwargs = dict(
 			model=claude_config['model'],
 			messages=messages, 
 			extra_headers={"X-TT-LOGID": claude_config['log_id']},  
@@ -281,6 +524,10 @@ def claude(messages):
 				}
 			}
 		)
+		if stream_parser is not None:
+			return _stream_chat(client, stream_parser, **create_kwargs)
+
+		response = client.chat.completions.create(**create_kwargs)
 
 		return response.choices[0].message.content
 			
@@ -290,10 +537,11 @@ def claude(messages):
 		print(f"请求失败: {e}")
 		return None
 
-def gpt(messages):
+def gpt(messages, stream_parser=None):
 	"""使用现有的claude API"""
 	# 从配置文件获取API配置
-	gpt_config = config['gpt']
+	import openai
+	gpt_config = get_config()['gpt']
 	
 	# 请求数据
 	client = openai.AzureOpenAI(
@@ -303,7 +551,7 @@ def gpt(messages):
 	)
 
 	try:
-		response = client.chat.completions.create(
+		create_kwargs = dict(
 			model=gpt_config['model'],
 			messages=messages, 
 			extra_headers={"X-TT-LOGID": gpt_config['log_id']},  
@@ -316,6 +564,10 @@ def gpt(messages):
 				}
 			}
 		)
+		if stream_parser is not None:
+			return _stream_chat(client, stream_parser, **create_kwargs)
+
+		response = client.chat.completions.create(**create_kwargs)
 		return response.choices[0].message.content
 			
 	except Exception as e:
@@ -325,7 +577,8 @@ def gpt(messages):
 def deer_flow(messages):
 	"""使用deer-flow API（假设本地运行）"""
 	# 从配置文件获取deer-flow配置
-	deer_config = config['deer_flow']
+	import requests
+	deer_config = get_config()['deer_flow']
 	deer_flow_url = deer_config['url']
 	
 	try:
@@ -362,24 +615,48 @@ def deer_flow(messages):
 		print(f"Deer-flow请求失败: {e}")
 		return None
 	
+telemetry_lock = threading.Lock()
+
+def telemetry_path():
+	return get_config().get('telemetry', {}).get('path', '.telemetry.jsonl')
+
+def record_telemetry(model, messages, response, seconds):
+	"""记录一次实际的模型调用（耗时与输入/输出token数），供dry-run估计吞吐"""
+	try:
+		record = {
+			'time': time.time(),
+			'model': model,
+			'seconds': round(seconds, 3),
+			'prompt_tokens': sum(count_tokens_batch([m['content'] for m in messages if isinstance(m.get('content'), str)])),
+			'completion_tokens': count_tokens(response) if isinstance(response, str) and response != ERROR_SIGN else None,
+			'ok': isinstance(response, str) and response != ERROR_SIGN,
+		}
+		with telemetry_lock:
+			with open(telemetry_path(), 'a', encoding='utf-8') as f:
+				f.write(json.dumps(record) + '\n')
+	except Exception as e:
+		logger.error(f'Error recording telemetry: {e}')
+
 @cached
-def _get_response(model, messages, nth_generation=0, **kwargs):
+def _get_response(model, messages, nth_generation=0, stream_parser=None, **kwargs):
 	# if messages is str
 	if isinstance(messages, str):
 		messages = [{"role": "user", "content": messages}]
 
+	start_time = time.time()
 	try:
 		if model == 'gemini_search': 
 			response = gemini(messages, search=True)
 		elif model == 'gemini':
 			response = gemini(messages)
 		elif model == 'claude-4-sonnet':
-			response = claude(messages)
+			response = claude(messages, stream_parser=stream_parser)
 		elif model.startswith('gpt'):
-			response = gpt(messages)
+			response = gpt(messages, stream_parser=stream_parser)
 		elif model == 'deer-flow':
 			pass
 		
+		record_telemetry(model, messages, response, time.time() - start_time)
 		return response
 
 	except Exception as e:
@@ -400,7 +677,38 @@ def _get_response(model, messages, nth_generation=0, **kwargs):
 		traceback.print_exc()
 		return None
 
-def get_response(post_processing_funcs=[], **kwargs):
+_sample_executor = None
+_sample_executor_lock = threading.Lock()
+
+def _sample_responses(kwargs, nth_generation, n_samples):
+	"""
+	并行请求n_samples个候选，第j个使用nth_generation + j作为缓存key（与逐次重试时的key相同）。
+	每个候选使用messages的独立副本，调用方返回后修改messages（如pop掉prompt）不影响仍在运行的候选及其缓存key。
+	"""
+	global _sample_executor
+	with _sample_executor_lock:
+		if _sample_executor is None:
+			from concurrent.futures import ThreadPoolExecutor
+			_sample_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix='sample')
+	return [_sample_executor.submit(_get_response, **dict(kwargs, messages=copy.deepcopy(kwargs['messages'])), nth_generation=nth_generation + j)
+		for j in range(n_samples)]
+
+_log_sampler = random.Random()
+
+def log_response(response):
+	"""按response_dump_rate采样完整记录模型回复，其余只在调用线程中截取预览，避免格式化和写出整段回复"""
+	if _log_sampler.random() < logging_config().get('response_dump_rate', 0.01):
+		logger.info('response by LLM: %s', response, extra={'full_payload': True})
+	else:
+		logger.info('response by LLM: %s', truncate_message(str(response), logging_config().get('max_message_chars', 4000)))
+
+def get_response(post_processing_funcs=[], n_samples=1, **kwargs):
+	"""
+	调用模型并用post_processing_funcs校验，不通过时重试。
+	n_samples > 1 时每轮并行请求n_samples个候选，按完成顺序返回第一个通过校验的，
+	被拒绝较多的prompt不再需要逐次串行重试。返回前取消尚未开始的候选并等待运行中的候选结束。
+	"""
+	from concurrent.futures import as_completed, wait
 	nth_generation = 0
 
 	while True:
@@ -409,27 +717,42 @@ def get_response(post_processing_funcs=[], **kwargs):
 			return None
 		
 		logger.info(f'{nth_generation}th generation')
-		response = _get_response(**kwargs, nth_generation=nth_generation)
-		logger.info(f'response by LLM: {response}')
-
-		if response is None:
-			continue 
-		
-		if response == ERROR_SIGN: # BLOCKED
-			nth_generation += 1
-			continue
-
-		# Break if we got a valid response, otherwise retry
-		# Run response through post-processing pipeline
-		for i, post_processing_func in enumerate(post_processing_funcs):
-			if response is None:
-				break
-			response = post_processing_func(response, **kwargs)
-
-		if response:
-			return response
+		if n_samples > 1:
+			candidates = _sample_responses(kwargs, nth_generation, n_samples)
+			responses = (future.result() for future in as_completed(candidates))
 		else:
-			nth_generation += 1
+			candidates = []
+			responses = [_get_response(**kwargs, nth_generation=nth_generation)]
+
+		n_none = 0
+		try:
+			for response in responses:
+				log_response(response)
+
+				if response is None:
+					n_none += 1
+					continue 
+				
+				if response == ERROR_SIGN: # BLOCKED
+					continue
+
+				# Break if we got a valid response, otherwise retry
+				# Run response through post-processing pipeline
+				for i, post_processing_func in enumerate(post_processing_funcs):
+					if response is None:
+						break
+					response = post_processing_func(response, **kwargs)
+
+				if response:
+					return response
+		finally:
+			for future in candidates:
+				future.cancel()
+			wait(candidates)
+
+		# 全部请求失败（None）时以相同的key重试，否则换下一批key
+		if n_none < n_samples:
+			nth_generation += n_samples
 			
 
 def ensure_question_format(response, **kwargs):
@@ -570,42 +893,123 @@ def extract_json(text, **kwargs):
 
 		text = re.sub(r'"([^"\\]*(\\.[^"\\]*)*)"', lambda m: m.group().replace('\n', r'\\n'), text) 
 		
-		#json_objects = re.findall(r'(\{[^{}]*\}|\[[^\[\]]*\])', text, re.DOTALL)
-
-		def parse_json_safely(text):
-			try:
-				result = json.loads(text)
-				return result
-			except json.JSONDecodeError:
-				results = []
-				start = 0
-				while start < len(text):
-					try:
-						obj, end = json.JSONDecoder().raw_decode(text[start:])
-						results.append(obj)
-						start += end
-					except json.JSONDecodeError:
-						start += 1
-				
-				if results:
-					longest_json = max(results, key=lambda x: len(json.dumps(x)))
-					return longest_json
-				else:
-					return None
-		
-		extracted_json = parse_json_safely(text)
+		# 单遍括号扫描取最长的可解析JSON，避免逐字符raw_decode的O(n²)开销
+		extracted_json = parse_longest_json(text)
 		
 		if extracted_json:
 			return extracted_json
 		else:
-			logger.error('Error parsing response: ', orig_text)
+			logger.error('Error parsing response: %s', orig_text)
 			return None
 	
 	res = _extract_json(text)
 
 	return res
 
-def stable_shuffle_tmp(entitys):
+def stable_string_hash(s):
+    """
+    Computes a deterministic 32-bit hash value for a string.
+
+    Uses a simple polynomial rolling hash function (similar to Java's String.hashCode())
+    with a multiplier of 31, so values are consistent across processes and runs.
+
+    Args:
+        s: Input string to hash
+
+    Returns:
+        32-bit integer hash value
+    """
+    h = 0
+    # Multiply by 31 at each step to distribute bits well
+    # Use bitwise AND with 0xFFFFFFFF to keep within 32 bits
+    for c in s:
+        h = (31 * h + ord(c)) & 0xFFFFFFFF
+    return h
+
+def stable_string_hashes(strings, legacy=True, chunk_size=200000):
+    """
+    Computes deterministic hash values for many strings in bulk.
+
+    With legacy=True the values are identical to `stable_string_hash`, but the
+    31-multiplier polynomial is evaluated with NumPy over the UTF-32 code points
+    of a whole chunk of strings at once, so orderings and shards produced by the
+    pure-Python version are reproduced exactly. With legacy=False each string is
+    hashed with 64-bit BLAKE2b (C-backed via hashlib), which spreads similar
+    strings far better but gives a different ordering.
+
+    Args:
+        strings: Sequence of strings to hash
+        legacy: Whether to use the Java-style hash of `stable_string_hash`
+        chunk_size: Number of strings hashed per NumPy batch
+
+    Returns:
+        np.ndarray of uint64 hash values, one per string
+    """
+    import numpy as np
+
+    if not legacy:
+        return np.fromiter((int.from_bytes(hashlib.blake2b(s.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+                            for s in strings), dtype=np.uint64, count=len(strings))
+
+    mask = np.uint64(0xFFFFFFFF)
+    hashes = np.zeros(len(strings), dtype=np.uint64)
+    for start in range(0, len(strings), chunk_size):
+        chunk = strings[start:start + chunk_size]
+        lengths = np.fromiter(map(len, chunk), dtype=np.int64, count=len(chunk))
+        total = int(lengths.sum())
+        if total == 0:
+            continue
+        codepoints = np.frombuffer(''.join(chunk).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.uint64)
+        # 31**i; uint64 arithmetic wraps modulo 2**64, which preserves the value modulo 2**32
+        powers = np.cumprod(np.concatenate([[1], np.full(int(lengths.max()) - 1, 31)]).astype(np.uint64))
+        ends = np.cumsum(lengths)
+        exponents = np.repeat(ends, lengths) - 1 - np.arange(total)
+        terms = codepoints * powers[exponents]
+        nonempty = lengths > 0
+        hashes[start:start + len(chunk)][nonempty] = np.add.reduceat(terms, (ends - lengths)[nonempty]) & mask
+    return hashes
+
+def smallest_k(hashes, k):
+    """
+    Returns the indices of the k smallest hashes, ordered by (hash, original position).
+
+    The result equals `np.argsort(hashes, kind='stable')[:k]`, but only needs an
+    O(n) partition plus a sort of the k selected items instead of a full sort.
+    """
+    import numpy as np
+
+    n = len(hashes)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(hashes, kind='stable')
+
+    kth = np.partition(hashes, k - 1)[k - 1]
+    below = np.flatnonzero(hashes < kth)
+    # Ties at the boundary are filled in original order, as a stable sort would
+    ties = np.flatnonzero(hashes == kth)[:k - len(below)]
+    chosen = np.concatenate([below, ties])
+    return chosen[np.argsort(hashes[chosen], kind='stable')]
+
+def stable_order(keys, k=None, legacy=True):
+    """
+    Deterministic ordering of string keys by their stable hash.
+
+    Equal hashes keep their input order, matching the stable sort used by
+    `stable_shuffle`. With k given only the first k positions are selected.
+
+    Args:
+        keys: Sequence of strings to order
+        k: Number of leading positions to return, None for all
+        legacy: See `stable_string_hashes`; True reproduces existing orderings
+
+    Returns:
+        np.ndarray of indices into keys
+    """
+    hashes = stable_string_hashes(keys, legacy=legacy)
+    return smallest_k(hashes, len(hashes) if k is None else k)
+
+def stable_shuffle_tmp(entitys, k=None, legacy=True):
     """
     Performs a deterministic shuffle of entity names using a custom hash function.
     
@@ -614,42 +1018,18 @@ def stable_shuffle_tmp(entitys):
     
     Args:
         entitys: List of entitynames (strings) to be shuffled
+        k: Only return the first k entities (without sorting the rest)
+        legacy: Keep the `stable_string_hash` ordering used by earlier runs
         
     Returns:
         List of entitynames in a deterministically shuffled order
         
     Note:
-        Uses a simple polynomial rolling hash function (similar to Java's String.hashCode())
-        with a multiplier of 31 to generate consistent hash values.
+        Ordering is given by `stable_order` of the entity label.
     """
-    def string_hash(s):
-        """
-        Computes a deterministic 32-bit hash value for a string.
-        
-        Args:
-            s: Input string to hash
-            
-        Returns:
-            32-bit integer hash value
-        """
-        h = 0
-        # Multiply by 31 at each step to distribute bits well
-        # Use bitwise AND with 0xFFFFFFFF to keep within 32 bits
-        for c in s:
-            h = (31 * h + ord(c)) & 0xFFFFFFFF
-        return h
-    
-    # Generate (entityname, hash) pairs for stable sorting
-    entitys_with_hash = [(entityname, string_hash(entityname['label'])) 
-                       for entityname in entitys]
-    
-    # Sort entitys based on their hash values for deterministic ordering
-    entitys_with_hash.sort(key=lambda x: x[1])
-    
-    # Extract and return just the entitynames in their new order
-    return [entity_hash_pair[0] for entity_hash_pair in entitys_with_hash]
+    return [entitys[i] for i in stable_order([entityname['label'] for entityname in entitys], k=k, legacy=legacy)]
 
-def stable_shuffle(entitys):
+def stable_shuffle(entitys, k=None, legacy=True):
     """
     Performs a deterministic shuffle of entity names using a custom hash function.
     
@@ -658,37 +1038,14 @@ def stable_shuffle(entitys):
     
     Args:
         entitys: List of entitynames (strings) to be shuffled
+        k: Only return the first k entities (without sorting the rest)
+        legacy: Keep the `stable_string_hash` ordering used by earlier runs
         
     Returns:
         List of entitynames in a deterministically shuffled order
         
     Note:
-        Uses a simple polynomial rolling hash function (similar to Java's String.hashCode())
-        with a multiplier of 31 to generate consistent hash values.
+        Ordering is given by `stable_order` of label + popularity_score.
     """
-    def string_hash(s):
-        """
-        Computes a deterministic 32-bit hash value for a string.
-        
-        Args:
-            s: Input string to hash
-            
-        Returns:
-            32-bit integer hash value
-        """
-        h = 0
-        # Multiply by 31 at each step to distribute bits well
-        # Use bitwise AND with 0xFFFFFFFF to keep within 32 bits
-        for c in s:
-            h = (31 * h + ord(c)) & 0xFFFFFFFF
-        return h
-    
-    # Generate (entityname, hash) pairs for stable sorting
-    entitys_with_hash = [(entityname, string_hash(entityname['label'] + str(entityname['popularity_score']))) 
-                       for entityname in entitys]
-    
-    # Sort entitys based on their hash values for deterministic ordering
-    entitys_with_hash.sort(key=lambda x: x[1])
-    
-    # Extract and return just the entitynames in their new order
-    return [entity_hash_pair[0] for entity_hash_pair in entitys_with_hash]
\ No newline at end of file
+    keys = [entityname['label'] + str(entityname['popularity_score']) for entityname in entitys]
+    return [entitys[i] for i in stable_order(keys, k=k, legacy=legacy)]
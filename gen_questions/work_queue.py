@@ -0,0 +1,103 @@
+import json
+import sqlite3
+import threading
+import time
+
+class WorkQueue:
+	"""
+	基于SQLite文件的实体任务队列，供多个gen_questions.py进程共享。
+
+	worker按批租用(lease)任务并定期续租(heartbeat)；处理失败时释放任务，
+	worker崩溃时租约过期后任务会被其他worker重新领取。超过max_attempts次
+	仍未完成的任务标记为failed，不再分配。
+	"""
+
+	def __init__(self, path, lease_seconds=600, max_attempts=3):
+		self.path = path
+		self.lease_seconds = lease_seconds
+		self.max_attempts = max_attempts
+		self._local = threading.local()
+
+		conn = self._conn()
+		conn.execute('PRAGMA journal_mode=WAL')
+		conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+			key TEXT PRIMARY KEY,
+			payload TEXT NOT NULL,
+			status TEXT NOT NULL DEFAULT 'pending',
+			worker TEXT,
+			lease_until REAL,
+			attempts INTEGER NOT NULL DEFAULT 0,
+			result TEXT,
+			updated_at REAL
+		)''')
+		conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, lease_until)')
+
+	def _conn(self):
+		# sqlite3连接不能跨线程使用，每个线程各自持有一个
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+			self._local.conn = conn
+		return conn
+
+	def enqueue(self, items):
+		"""items: [(key, payload_dict)]，已存在的key会被忽略。返回新加入的任务数"""
+		conn = self._conn()
+		now = time.time()
+		conn.execute('BEGIN IMMEDIATE')
+		before = conn.total_changes
+		conn.executemany('INSERT OR IGNORE INTO tasks (key, payload, updated_at) VALUES (?, ?, ?)',
+			((key, json.dumps(payload, ensure_ascii=False), now) for key, payload in items))
+		added = conn.total_changes - before
+		conn.execute('COMMIT')
+		return added
+
+	def lease(self, worker, n):
+		"""为worker租用至多n个任务（待处理或租约已过期的），返回 [(key, payload_dict)]"""
+		if n <= 0:
+			return []
+		conn = self._conn()
+		now = time.time()
+		conn.execute('BEGIN IMMEDIATE')
+		try:
+			# 租约过期且已用尽重试次数的任务不再分配
+			conn.execute('''UPDATE tasks SET status = 'failed', worker = NULL, updated_at = ?
+				WHERE status = 'leased' AND lease_until < ? AND attempts >= ?''', (now, now, self.max_attempts))
+			rows = conn.execute('''SELECT key, payload FROM tasks
+				WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?)
+				ORDER BY rowid LIMIT ?''', (now, n)).fetchall()
+			conn.executemany('''UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+				WHERE key = ?''', ((worker, now + self.lease_seconds, now, key) for key, _ in rows))
+			conn.execute('COMMIT')
+		except Exception:
+			conn.execute('ROLLBACK')
+			raise
+		return [(key, json.loads(payload)) for key, payload in rows]
+
+	def heartbeat(self, worker, keys):
+		"""为worker仍在处理的任务续租"""
+		if not keys:
+			return
+		now = time.time()
+		self._conn().executemany('''UPDATE tasks SET lease_until = ?, updated_at = ?
+			WHERE key = ? AND worker = ? AND status = 'leased' ''', ((now + self.lease_seconds, now, key, worker) for key in keys))
+
+	def complete(self, worker, key, result):
+		"""记录任务结果。即使租约已被他人接手，先完成的结果也会被保留"""
+		self._conn().execute('''UPDATE tasks SET status = 'done', worker = ?, result = ?, updated_at = ?
+			WHERE key = ? AND status != 'done' ''', (worker, json.dumps(result, ensure_ascii=False), time.time(), key))
+
+	def release(self, worker, key):
+		"""处理失败时释放任务，使其立刻可被重新领取；重试次数用尽则标记为failed"""
+		self._conn().execute('''UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+			worker = NULL, lease_until = NULL, updated_at = ?
+			WHERE key = ? AND worker = ? AND status = 'leased' ''', (self.max_attempts, time.time(), key, worker))
+
+	def counts(self):
+		"""各状态的任务数"""
+		return dict(self._conn().execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())
+
+	def results(self):
+		"""遍历已完成任务的 (key, result)"""
+		for key, result in self._conn().execute("SELECT key, result FROM tasks WHERE status = 'done' ORDER BY rowid"):
+			yield key, json.loads(result)
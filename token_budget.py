@@ -0,0 +1,192 @@
+import os
+import threading
+
+POLICIES = ('drop', 'truncate_tool')
+TRUNCATION_MARKER = '\n...[truncated]'
+DEFAULT_TOKENIZER = 'cl100k_base'
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(encoding_name):
+    """按名称缓存tiktoken编码，避免重复构建"""
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(encoding_name)
+            if encoding is None:
+                import tiktoken
+                encoding = _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return encoding
+
+
+class TiktokenBackend:
+    """tiktoken编码，只在没有目标模型tokenizer时使用，计数与SFT模型的实际token数可能相差较多（中文尤甚）"""
+
+    def __init__(self, encoding_name):
+        self.encoding = get_encoding(encoding_name)
+
+    def encode_batch(self, texts, num_threads=8):
+        return self.encoding.encode_ordinary_batch(texts, num_threads=num_threads)
+
+    def truncate(self, text, n_tokens):
+        """前n_tokens个token对应的文本，不完整的UTF-8字符丢弃"""
+        tokens = self.encoding.encode_ordinary(text)
+        return self.encoding.decode_bytes(tokens[:n_tokens]).decode('utf-8', errors='ignore')
+
+
+class HFTokenizerBackend:
+    """SFT模型自身的HF tokenizer（AutoTokenizer），计数与MAX_LENGTH的口径一致"""
+
+    def __init__(self, path):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+
+    def encode_batch(self, texts, num_threads=8):
+        # fast tokenizer的批量编码本身是多线程的
+        return self.tokenizer(texts, add_special_tokens=False)['input_ids']
+
+    def truncate(self, text, n_tokens):
+        if self.tokenizer.is_fast:
+            offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+            n_tokens = min(n_tokens, len(offsets))
+            return text[:offsets[n_tokens - 1][1]] if n_tokens > 0 else ''
+        ids = self.tokenizer(text, add_special_tokens=False)['input_ids']
+        return self.tokenizer.decode(ids[:n_tokens])
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def is_model_tokenizer(tokenizer):
+    """tokenizer是否为HF tokenizer的目录或hub名称（含'/'或是已存在的路径），否则视为tiktoken编码名（如'cl100k_base'）"""
+    return os.path.exists(tokenizer) or '/' in tokenizer
+
+
+def get_backend(tokenizer):
+    """HF tokenizer（见is_model_tokenizer）使用AutoTokenizer，否则使用tiktoken编码。按名称缓存。"""
+    backend = _backends.get(tokenizer)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(tokenizer)
+            if backend is None:
+                if is_model_tokenizer(tokenizer):
+                    backend = HFTokenizerBackend(tokenizer)
+                else:
+                    backend = TiktokenBackend(tokenizer)
+                _backends[tokenizer] = backend
+    return backend
+
+
+def _water_level(counts, budget):
+    """最大的上限L，使 sum(min(c, L)) <= budget；不需要截断时返回None"""
+    remaining = budget
+    n = len(counts)
+    for i, c in enumerate(sorted(counts)):
+        # 较短的消息完整保留，剩余n-i条截到同一上限
+        if c * (n - i) <= remaining:
+            remaining -= c
+        else:
+            return remaining // (n - i)
+    return None
+
+
+class TokenBudget:
+    """
+    按消息统计token数（规范化、替换system prompt之后的最终内容），并把超长轨迹裁剪到max_tokens以内。
+
+    tokenizer应为SFT模型自身的HF tokenizer路径，MAX_LENGTH按它计算；未提供时退回tiktoken编码（见get_backend），
+    此时计数只是近似，调用方应保留按预先计算的长度的筛选（见uses_model_tokenizer）。
+    每条消息计为 内容token数 + per_message_overhead（chat模板中role、BOS/EOS等的token）。
+    同一批轨迹的所有消息合并为一次批量编码。
+
+    裁剪策略：
+    - 'drop'：超长即丢弃，与原先只看预先计算的长度一致；
+    - 'truncate_tool'：只截短tool消息（loss_mask为0，不参与训练），从最长的开始截到同一上限，
+      保留开头（工具调用信息和前面的结果）并加上TRUNCATION_MARKER；非tool消息本身已超长时仍丢弃。
+    """
+
+    def __init__(self, max_tokens, policy='truncate_tool', tokenizer=DEFAULT_TOKENIZER, per_message_overhead=4,
+                 min_tool_tokens=64, num_threads=8):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown truncation policy {policy!r}, expected one of {POLICIES}')
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.tokenizer = tokenizer
+        self.per_message_overhead = per_message_overhead
+        self.min_tool_tokens = min_tool_tokens
+        self.num_threads = num_threads
+
+    @property
+    def uses_model_tokenizer(self):
+        """是否按SFT模型自身的tokenizer计数；为False时计数与MAX_LENGTH的口径不一致"""
+        return is_model_tokenizer(self.tokenizer)
+
+    @property
+    def backend(self):
+        return get_backend(self.tokenizer)
+
+    def count_many(self, trajectories):
+        """trajectories为 [messages]，返回每条轨迹各消息的token数 [[int]]（不含overhead），全部消息一次批量编码"""
+        contents = [m['content'] for messages in trajectories for m in messages]
+        lengths = [len(tokens) for tokens in self.backend.encode_batch(contents, num_threads=self.num_threads)]
+        counts = []
+        start = 0
+        for messages in trajectories:
+            counts.append(lengths[start:start + len(messages)])
+            start += len(messages)
+        return counts
+
+    def count(self, messages):
+        return self.count_many([messages])[0]
+
+    def total(self, counts):
+        return sum(counts) + self.per_message_overhead * len(counts)
+
+    def _truncate(self, text, limit):
+        """截到limit个token（含TRUNCATION_MARKER），在token边界截断"""
+        keep = max(limit - len(self.backend.encode_batch([TRUNCATION_MARKER])[0]), 0)
+        return self.backend.truncate(text, keep) + TRUNCATION_MARKER
+
+    def fit(self, messages, counts=None):
+        """
+        把一条轨迹裁剪到max_tokens以内。counts为各消息的token数（count/count_many的结果），None时重新统计。
+        返回 (裁剪后的messages, {num_tokens, num_truncated})；无法裁剪时返回 (None, 原因)。
+        不修改传入的messages。
+        """
+        if counts is None:
+            counts = self.count(messages)
+        total = self.total(counts)
+        if total <= self.max_tokens:
+            return messages, {'num_tokens': total, 'num_truncated': 0}
+        if self.policy == 'drop':
+            return None, f'{total} tokens > {self.max_tokens}'
+
+        tool_indices = [i for i, m in enumerate(messages) if m['role'] == 'tool']
+        fixed = self.total([c for i, c in enumerate(counts) if messages[i]['role'] != 'tool']) + self.per_message_overhead * len(tool_indices)
+        budget = self.max_tokens - fixed
+        if budget < self.min_tool_tokens * len(tool_indices):
+            return None, f'{total} tokens > {self.max_tokens} and non-tool messages alone take {fixed}'
+
+        messages = list(messages)
+        counts = list(counts)
+        truncated = set()
+        # 解码再编码后token边界可能变化，截断后重新统计，仍超出时把超出部分从上限中扣除后再截
+        for _ in range(3):
+            limit = _water_level([counts[i] for i in tool_indices], budget)
+            if limit is None:
+                break
+            limit = max(limit, self.min_tool_tokens)
+            over = [i for i in tool_indices if counts[i] > limit]
+            for i in over:
+                messages[i] = dict(messages[i], content=self._truncate(messages[i]['content'], limit))
+            for i, n in zip(over, self.count_many([[messages[i] for i in over]])[0]):
+                counts[i] = n
+            truncated.update(over)
+            total = self.total(counts)
+            if total <= self.max_tokens:
+                return messages, {'num_tokens': total, 'num_truncated': len(truncated)}
+            budget -= total - self.max_tokens
+        return None, f'still {total} tokens > {self.max_tokens} after truncating tool messages'
@@ -0,0 +1,115 @@
+import re
+
+# 工具输出中需要替换为英文的字段名和星期（按此表顺序逐个str.replace与单遍替换结果一致）
+DEFAULT_MAPPING = [
+    ('[摘要]', '[summary]'),
+    ('[标题]', '[title]'),
+    ('[序号]', '[number]'),
+    ('[发布时间]', '[publish_time]'),
+    ('[来源]', '[source]'),
+    ('（星期一）', '(Monday)'),
+    ('（星期二）', '(Tuesday)'),
+    ('（星期三）', '(Wednesday)'),
+    ('（星期四）', '(Thursday)'),
+    ('（星期五）', '(Friday)'),
+    ('（星期六）', '(Saturday)'),
+    ('（星期日）', '(Sunday)'),
+]
+
+_DATE = r'\[发布时间\] (\d{4})年(\d{1,2})月(\d{1,2})日'
+_NO_DATE = '[发布时间] 无'
+
+
+class ToolTextNormalizer:
+    """
+    单遍规范化工具输出：所有替换合并为一个编译好的正则（日期改写 | '[发布时间] 无' | mapping中的各个词），
+    只扫描一遍文本。结果与依次执行日期re.sub、'[发布时间] 无'替换和mapping中各个str.replace相同。
+    """
+
+    def __init__(self, mapping=DEFAULT_MAPPING):
+        self.mapping = dict(mapping)
+        # 日期改写后的'[发布时间]'同样按mapping替换
+        self.date_field = self.mapping.get('[发布时间]', '[发布时间]')
+        # 长词优先，避免某个词的前缀先匹配
+        words = sorted(self.mapping, key=len, reverse=True)
+        self.pattern = re.compile('|'.join([_DATE, re.escape(_NO_DATE)] + [re.escape(word) for word in words]))
+
+    def _replace(self, m):
+        if m.group(1) is not None:
+            return f'{self.date_field} {m.group(1)}-{m.group(2)}-{m.group(3)}'
+        text = m.group()
+        if text == _NO_DATE:
+            return '[publish_time] None'
+        return self.mapping[text]
+
+    def normalize(self, text):
+        return self.pattern.sub(self._replace, text)
+
+
+_default = ToolTextNormalizer()
+
+
+def normalize_tool_text(text):
+    """用默认mapping规范化一段工具输出"""
+    return _default.normalize(text)
+
+
+def legacy_normalize(text, mapping=DEFAULT_MAPPING):
+    """原先逐遍替换的实现，仅用于基准对比"""
+    text = re.sub(r'(\[发布时间\] \d{4})年(\d{1,2})月(\d{1,2})日', r'\1-\2-\3', text)
+    text = text.replace("[发布时间] 无", "[publish_time] None")
+    for zh_word, en_word in mapping:
+        text = text.replace(zh_word, en_word)
+    return text
+
+
+if __name__ == '__main__':
+    # 基准：以真实的工具输出为语料（filter_traj的{idx}_agent.json中的tool消息，或SFT parquet的prompt+gen），对比新旧实现
+    import argparse
+    import glob
+    import json
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description="工具输出规范化的吞吐基准")
+    parser.add_argument("paths", nargs='+', help="*_agent.json文件、parquet文件或包含它们的目录")
+    parser.add_argument("--limit", type=int, default=20000, help="最多使用的文本条数")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快的一次")
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(f'{path}/**/*_agent.json', recursive=True))
+            files.extend(glob.glob(f'{path}/**/*.parquet', recursive=True))
+        else:
+            files.append(path)
+
+    corpus = []
+    for file in files:
+        if len(corpus) >= args.limit:
+            break
+        if file.endswith('.parquet'):
+            import pandas as pd
+            df = pd.read_parquet(file, columns=['prompt', 'gen'])
+            corpus.extend((df['prompt'] + df['gen']).tolist())
+        else:
+            with open(file, 'r') as f:
+                corpus.extend(m['content'] for m in json.load(f) if m.get('role') == 'tool' and isinstance(m.get('content'), str))
+    corpus = corpus[:args.limit]
+    n_bytes = sum(len(text.encode('utf-8')) for text in corpus)
+    print(f"语料: {len(corpus)} 条，共 {n_bytes / 1e6:.1f} MB")
+
+    timings = {}
+    outputs = {}
+    for name, func in [('legacy', legacy_normalize), ('single-pass', normalize_tool_text)]:
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outputs[name] = [func(text) for text in corpus]
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+        print(f"{name}: {best:.3f}s, {n_bytes / 1e6 / max(best, 1e-9):.1f} MB/s")
+
+    same = sum(a == b for a, b in zip(outputs['legacy'], outputs['single-pass']))
+    print(f"加速 {timings['legacy'] / max(timings['single-pass'], 1e-9):.1f}x，结果一致 {same}/{len(corpus)}")
@@ -3,94 +3,125 @@ import pandas as pd
 import json
 import argparse
 import sys
+from collections import Counter
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from tool_normalizer import normalize_tool_text
+from token_budget import TokenBudget, POLICIES, DEFAULT_TOKENIZER
 
 
-def convert_parquet_to_oai(file_path):
+def parse_messages(messages_str):
+    """把一条rollout（prompt + gen）按BOS/EOS拆成SFT消息列表，先做工具输出的规范化；格式不符时抛出ValueError"""
+    # 单遍完成日期改写（2018年5月7日 -> 2018-5-7）和字段名、星期的中英替换
+    messages_str = normalize_tool_text(messages_str)
+    
+    messages = []
+    message_pieces = messages_str.split('<[BOS_never_used_51bce0c785ca2f68081bfa7d91973934]>')[1:]
+    last_tool = None
+    for message_piece in message_pieces:
+        role = None
+        for m_role in ['system', 'user', 'assistant', 'tool']:
+            if message_piece.startswith(m_role):
+                role = m_role 
+                break
+        if role is None:
+            raise ValueError(f'unknown role: {message_piece[:50]!r}')
+
+        message_piece = message_piece.replace(role, '', 1).strip(' \n')
+        if '<[EOS_never_used_51bce0c785ca2f68081bfa7d91973934]>' not in message_piece:
+            raise ValueError(f'{role} message without EOS')
+        message_piece = message_piece.split('<[EOS_never_used_51bce0c785ca2f68081bfa7d91973934]>')[0]
+        message_piece = message_piece.strip()
+        
+        if len(message_piece) == 0:
+            raise ValueError(f'empty {role} message')
+        if '|FunctionCallBegin|' in message_piece:
+            function_call = message_piece.split('|FunctionCallBegin|')[-1]
+            if '"read_beautiful_soup"' in function_call:
+                last_tool = '"read_beautiful_soup"'
+            elif '"search_bing"' in function_call:
+                last_tool = '"search_bing"'
+            elif not ('"function_name"' in function_call):
+                raise ValueError(f'unknown tool call: {function_call[:100]!r}')
+            
+        if len(messages) > 0 and messages[-1]['role'] == role:
+            messages[-1]['content'] += message_piece
+        else:
+            if role == 'assistant': 
+                loss_mask = 1.0
+            else:
+                loss_mask = 0.0
+            if role == 'tool':
+                n = last_tool
+                if n is None:
+                    raise ValueError('tool message before any tool call')
+            else:
+                n = ''
+            messages.append({"role": role, "content": message_piece, "loss_mask": loss_mask, "name": n})
+    return messages
+
+
+def iter_rollout_batches(file_path, max_len=None, batch_size=1024):
+    """
+    按批流式读取parquet，只读score、len、prompt、gen四列；score == 1和len < max_len在Arrow层面筛选，
+    每批产出筛选后的 prompt + gen 字符串列表。内存占用只与batch_size有关，与文件大小无关。
+    """
+    parquet_file = pq.ParquetFile(file_path)
+    print(f'Dataset Size: {parquet_file.metadata.num_rows}')
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['score', 'len', 'prompt', 'gen']):
+        mask = pc.equal(batch.column('score'), 1)
+        if max_len is not None:
+            mask = pc.and_(mask, pc.less(batch.column('len'), max_len))
+        batch = batch.filter(mask)
+        if batch.num_rows:
+            yield [prompt + gen for prompt, gen in zip(batch.column('prompt').to_pylist(), batch.column('gen').to_pylist())]
+
+
+def convert_parquet_to_oai(file_path, budget=None, max_samples=4000):
     """
     读取parquet文件并随机采样数据，以格式化JSON输出
     
     Args:
         file_path: parquet文件路径
-        num_samples: 采样数量，默认2条
+        budget: TokenBudget，按解析后的消息统计token数并裁剪超长轨迹；为None时只按预先计算的len筛选
+        max_samples: 最多保留的样本数，取满后不再读取剩余的批次
     """
 
-    # 读取parquet文件
-    df = pd.read_parquet(file_path)
-    
-    print(f'Dataset Size: {len(df)}')
-    # 随机采样
-    json_data = []
+    # 按SFT模型自身的tokenizer裁剪时交给budget按实际token数处理，否则仍用预先计算的len提前筛掉
+    max_len = None if budget is not None and budget.policy != 'drop' and budget.uses_model_tokenizer else 32000
     sft_data = []
-    for _, row in df.iterrows():
-        row_dict = {}
-        for col, value in row.items():
-            # 处理numpy数组和其他不可序列化的类型
-            if hasattr(value, 'tolist'):
-                row_dict[col] = value.tolist()
-            elif pd.isna(value):
-                row_dict[col] = None
-            else:
-                row_dict[col] = value
-        
-        if row_dict["score"] == 1 and row_dict["len"] < 32000:
-            messages_str = row_dict['prompt'] + row_dict['gen']
-            orig_messages_str = messages_str
-            import re
-            messages_str = re.sub(r'(\[发布时间\] \d{4})年(\d{1,2})月(\d{1,2})日', r'\1-\2-\3', messages_str)
-            messages_str = messages_str.replace("[发布时间] 无", "[publish_time] None")
-            for zh_word, en_word in [('[摘要]', '[summary]'), ('[标题]', '[title]'), ('[序号]', '[number]'), ('[发布时间]', '[publish_time]'), ('[来源]', '[source]'), ('（星期一）', '(Monday)'), ('（星期二）', '(Tuesday)'), ('（星期三）', '(Wednesday)'), ('（星期四）', '(Thursday)'), ('（星期五）', '(Friday)'), ('（星期六）', '(Saturday)'), ('（星期日）', '(Sunday)'),]:
-                messages_str = messages_str.replace(zh_word, en_word)
-            # 用正则表达式 识别这样的日期 2018年5月7日 变成 2018-05-07
-            
-            messages = []
-            message_pieces = messages_str.split('<[BOS_never_used_51bce0c785ca2f68081bfa7d91973934]>')[1:]
-            last_tool = None
-            for message_piece in message_pieces:
-                role = None
-                for m_role in ['system', 'user', 'assistant', 'tool']:
-                    if message_piece.startswith(m_role):
-                        role = m_role 
-                        break
-                assert role is not None
-
-                message_piece = message_piece.replace(role, '', 1).strip(' \n')
-                try:
-                    assert ('<[EOS_never_used_51bce0c785ca2f68081bfa7d91973934]>' in message_piece)
-                except:
-                    import pdb; pdb.set_trace()
-                message_piece = message_piece.split('<[EOS_never_used_51bce0c785ca2f68081bfa7d91973934]>')[0]
-                message_piece = message_piece.strip()
-                
-                assert (len(message_piece) > 0)
-                if '|FunctionCallBegin|' in message_piece:
-                    function_call = message_piece.split('|FunctionCallBegin|')[-1]
-                    if '"read_beautiful_soup"' in function_call:
-                        last_tool = '"read_beautiful_soup"'
-                    elif '"search_bing"' in function_call:
-                        last_tool = '"search_bing"'
-                    else:
-                        if not ('"function_name"' in function_call):
-                            import pdb; pdb.set_trace()
-                    
-                if len(messages) > 0 and messages[-1]['role'] == role:
-                    messages[-1]['content'] += message_piece
-                else:
-                    if role == 'assistant': 
-                        loss_mask = 1.0
-                    else:
-                        loss_mask = 0.0
-                    if role == 'tool':
-                        n = last_tool
-                        assert n is not None
-                    else:
-                        n = ''
-                    messages.append({"role": role, "content": message_piece, "loss_mask": loss_mask, "name": n})
-                    
-            sft_data.append({'messages': messages})
-                    
-        json_data.append(row_dict)
-    
-    sft_data = sft_data[:4000]
+    fit_stats = Counter()
+    malformed = Counter()
+    for messages_strs in iter_rollout_batches(file_path, max_len):
+        batch = []
+        for messages_str in messages_strs:
+            # 格式不符的rollout跳过并计数，不中断整个文件
+            try:
+                batch.append(parse_messages(messages_str))
+            except ValueError as e:
+                malformed[str(e).split(':')[0]] += 1
+        if budget is not None:
+            # 同一批轨迹的消息合并编码，再逐条裁剪
+            fitted = []
+            for messages, counts in zip(batch, budget.count_many(batch)):
+                messages, info = budget.fit(messages, counts)
+                if messages is None:
+                    fit_stats['dropped'] += 1
+                    continue
+                if info['num_truncated']:
+                    fit_stats['truncated'] += 1
+                fitted.append(messages)
+            batch = fitted
+        sft_data.extend({'messages': messages} for messages in batch)
+        if len(sft_data) >= max_samples:
+            break
+
+    sft_data = sft_data[:max_samples]
+    if malformed:
+        print(f'跳过格式不符的样本 {sum(malformed.values())} 条: {dict(malformed)}')
+    if budget is not None:
+        print(f'token budget {budget.max_tokens} ({budget.policy}): {dict(fit_stats)}')
 
     print(f'RS 样本数量 {len(sft_data)}')
     output_file = file_path.replace('val.', '', 1).replace('.parquet', '.json')
@@ -98,7 +129,6 @@ def convert_parquet_to_oai(file_path):
         json.dump(sft_data, f, indent=2, ensure_ascii=False)
     print(f"SFT JSON文件已保存到: {output_file}")
 
-    import pdb; pdb.set_trace()
     output_file = file_path.replace('val.', '', 1)
     df = pd.DataFrame(sft_data)
     df.to_parquet(output_file)
@@ -113,6 +143,9 @@ def convert_parquet_to_oai(file_path):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="可视化parquet文件数据")
     parser.add_argument("dir_path", help="parquet文件路径")
+    parser.add_argument("--max-tokens", type=int, default=32000, help="每条轨迹的token上限")
+    parser.add_argument("--truncate-policy", choices=POLICIES, default='truncate_tool', help="超长时的处理：drop丢弃，truncate_tool截短tool消息")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER, help="SFT模型的HF tokenizer路径（与token上限口径一致）；未提供时退回tiktoken编码，计数与实际可能相差较多，并保留按预先计算长度的筛选")
 
     args = parser.parse_args()
     # 遍历所有./traj下的parquet文件，如果不存在同名json文件，则调用convert_parquet_to_json
@@ -122,7 +155,7 @@ if __name__ == "__main__":
     #for file_path in glob.glob(f'{args.dir_path}/**/val*.parquet', recursive=True):
     for file_path in glob.glob(f'{args.dir_path}/**/val*.parquet', recursive=True):
         #if not os.path.exists(file_path.replace('val.', '')):
-        convert_parquet_to_oai(file_path)
+        convert_parquet_to_oai(file_path, TokenBudget(args.max_tokens, policy=args.truncate_policy, tokenizer=args.tokenizer))
     
 # python visualize_parquet.py /root/wxt/bc/gen_questions/parquet_files_v1/train4.parquet
 # python visualize_parquet.py /root/wxt/DeepResearcher/data/test_small.parquet